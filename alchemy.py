@@ -21,48 +21,118 @@
 #       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 #       MA 02110-1301, USA.
 
+import atexit
 import random
-import json
 import os.path
 import sys
-import shutil
 import math
+import time
 
 import pygame
 
+from assets import AssetCache, Images
+from engine import ELEMENTS, Engine
+from highscores import GLOBAL, HighScores, level_board
+from history import History
+from levelcache import LevelCache
+from profiler import Profiler
+from profiles import ProfileStore, migrate_files
+from render import GridRenderer, SpriteCache, TextCache, allocations
+from replay import Recorder
+from storage import SaveService
+
 SCREEN_SIZE = 1024, 800
-GRID_OFFSET = (300, 180)
+# Screen area the grid view is centered in
+GRID_AREA = pygame.Rect(300, 180, 480, 480)
 NEXT_OFFSET = (20, 40)
 
 WHITE = (255, 255, 255)
 GREY = (70, 70, 70)
-ELEMENTS = {
-    "1": "mercury",
-    "2": "saturn",
-    "3": "jupiter",
-    "4": "moon",
-    "5": "venus",
-    "6": "mars",
-    "7": "sun",
-    "1s": "mercury_spoilt",
-    "2s": "saturn_spoilt",
-    "3s": "jupiter_spoilt",
-    "5s": "venus_spoilt",
-    "6s": "mars_spoilt",
-    "o": "old"
-    }
 
 LEVELS = (1, 2, 3, 4, 5)
 
+# How many recently played profiles the "New user" dialog offers
+RECENT_PROFILES = 6
+# How many of the best runs the level screen shows
+HALL_OF_FAME = 5
+
+# The main menu has to be on the screen this soon after the start, in seconds
+STARTUP_BUDGET = 0.2
+
+# Arrow keys scroll the view over boards bigger than it
+SCROLL_KEYS = {
+    pygame.K_UP: (-1, 0),
+    pygame.K_DOWN: (1, 0),
+    pygame.K_LEFT: (0, -1),
+    pygame.K_RIGHT: (0, 1),
+    }
 
-def img_load(dir, file):
-    '''Helper function for loading images'''
-    return pygame.image.load(os.path.join(dir, file)).convert_alpha()    
+# Toggles the performance overlay, which is redrawn this often (in seconds)
+OVERLAY_KEY = pygame.K_F3
+# Ctrl + these keys take a move back and make it again
+UNDO_KEY = pygame.K_z
+REDO_KEY = pygame.K_y
+OVERLAY_PERIOD = 0.5
+OVERLAY_RECT = pygame.Rect(760, 10, 260, 75)
+
+# Posted by pygame to stop waiting for events, see EventDispatcher.wait()
+WAKE_EVENT = pygame.USEREVENT
+
+
+class EventDispatcher(object):
+    '''
+    The single source of input for all game screens.
+    Every call takes all the queued events at once, so no click or keystroke
+    is lost. Mouse motions in a row are coalesced into the latest one, and
+    when nothing is pending we sleep instead of polling.
+    '''
+    def fetch(self, timeout = None):
+        '''
+        Return the list of pending events. If there are none, wait for them
+        at most "timeout" milliseconds (forever if timeout is None).
+        '''
+        events = pygame.event.get()
+        if not events and timeout != 0:
+            events = [self.wait(timeout)] + pygame.event.get()
+        return self.coalesce(events)
+
+    @staticmethod
+    def wait(timeout):
+        '''Block until the next event or until the timeout expires'''
+        if timeout is not None:
+            pygame.time.set_timer(WAKE_EVENT, max(1, timeout))
+        event = pygame.event.wait()
+        if timeout is not None:
+            pygame.time.set_timer(WAKE_EVENT, 0)
+        return event
+
+    @staticmethod
+    def coalesce(events):
+        '''
+        Drop our own wake up events and keep only the last of mouse motions
+        that follow each other. A motion before a click or a key stays, so
+        the click is handled with the figure where the mouse was.
+        '''
+        coalesced = []
+        for event in events:
+            if event.type == WAKE_EVENT: continue
+            if (event.type == pygame.MOUSEMOTION and coalesced and
+                coalesced[-1].type == pygame.MOUSEMOTION):
+                coalesced[-1] = event
+            else:
+                coalesced.append(event)
+        return coalesced
 
 
 class Game(object):
-    def __init__(self):
-        '''Initialize the game, load resources and show the main menu'''        
+    def __init__(self, debug = False, trace = None):
+        '''Initialize the game and load resources'''        
+        self.started = time.time()
+        self.debug = debug
+        # Level frames are timed, and written to the "trace" file if it's given
+        self.profiler = Profiler(trace)
+        atexit.register(self.profiler.close)
+        self.overlay = False
         pygame.init()
         
         # Create the game window, set icon and window title
@@ -70,38 +140,69 @@ class Game(object):
         self.screen = pygame.display.set_mode(SCREEN_SIZE, 0, 32)
         pygame.display.set_caption("Alchemy")
         
-        # Clock will be used for polling events
-        self.clock = pygame.time.Clock()
+        # All the screens get their input from here
+        self.events = EventDispatcher()
+        # Settings and progress are saved in the background, and everything
+        # pending is written before the game exits
+        self.saves = SaveService()
+        atexit.register(self.saves.close)
+        # User progress lives in the profile database. Users who still
+        # have "<name>_progress" files get them imported.
+        self.profiles = ProfileStore("profiles.db")
+        atexit.register(self.profiles.close)
+        migrate_files(self.profiles)
+        self.highscores = HighScores("highscores.db")
+        atexit.register(self.highscores.close)
+        # Levels are validated once and loaded from a compiled pack. Invalid
+        # levels stay out of it and fail when they are played.
+        self.levels = LevelCache("levels")
+        atexit.register(self.levels.close)
+        try:
+            compiled, errors = self.levels.update()
+            for level_id in sorted(errors):
+                print errors[level_id]
+        except (IOError, OSError):
+            pass    # The levels directory is read only, levels are read from their files
         
         self.load_resources()
-        self.main_menu()
+
+    def run(self):
+        '''
+        Show game screens one after another, starting with the main menu.
+        Every screen returns the next one as a tuple (method, arguments...)
+        instead of calling it, so the stack doesn't grow however many
+        levels are played.
+        '''
+        scene = (self.main_menu,)
+        while scene:
+            scene = scene[0](*scene[1:])
 
     def load_resources(self):
-        '''Load images, fonts, sounds, etc'''
-        self.images = {}
+        '''
+        Load fonts and settings, and tell where the images are.
+        Images are only loaded when they are first shown, so the main menu
+        doesn't wait for in-game images.
+        '''
+        self.assets = AssetCache("images")
+        self.images = Images(self.assets)
         
         # In-game images
-        self.images['grid'] = img_load("images", "grid.jpg")
-        self.images['shadow'] = img_load("images", "shadow.png")
-        self.images['border'] = img_load("images", "border.png")
-        self.images['grid_border'] = img_load("images", "grid_border.png")
-        self.images['sulphur'] = img_load("images", "sulphur.png")
-        self.images['sulphur_b'] = img_load("images", "sulphur_b.png")
-        self.images['sulphur_bd'] = self.images['sulphur_b'].copy()
-        self.images['sulphur_bd'].fill(GREY, None, pygame.BLEND_SUB)
-        
-        # In-game element images
+        self.images.add('grid', "grid.jpg")
+        for name in ('shadow', 'border', 'grid_border', 'sulphur', 'sulphur_b'):
+            self.images.add(name, name + ".png")
+        self.images.add('sulphur_bd', self.darkened_sulphur)
+        
+        # In-game element images come from the sprite atlas
+        self._sprites = None
         for element in ELEMENTS.values():
-            self.images[element] = img_load("images", element + ".png")
+            self.images.add(element, lambda element = element: self.sprites.sprite(element))
                     
         # GUI images
-        self.images['menu_bg'] = img_load("images", "menu_bg.png")
-        self.images['msg'] = img_load("images", "msg.png")
-        self.images['level_menu'] = img_load("images", "level_menu.png")
-        self.images['new_user'] = img_load("images", "new_user.png")
-        self.images['ok'] = img_load("images", "ok.png")
+        for name in ('menu_bg', 'msg', 'level_menu', 'new_user', 'ok'):
+            self.images.add(name, name + ".png")
         
-        # Fonts
+        # Fonts, and all the text rendered with them
+        self.texts = TextCache()
         self.big_font = pygame.font.Font("fonts/eufm10.ttf", 26)
         self.smaller_font = pygame.font.Font("fonts/eufm10.ttf", 22)
         self.biggest_font = pygame.font.Font("fonts/eufm10.ttf", 106)
@@ -109,105 +210,146 @@ class Game(object):
         # ./settings_init file contains initial game settings.
         # ./settings is the file that we actually work with.
         # If ./settings does not exist, we create it from ./settings_init.
-        if not os.path.exists("settings"): shutil.copyfile("settings_init", "settings")
+        if not os.path.exists("settings"): self.saves.save("settings", self.saves.load("settings_init"))
 
-    def main_menu(self):
+    @property
+    def sprites(self):
+        '''
+        Normal and darkened versions of element images for the grid and the
+        figure, packed into one atlas the first time they are needed
+        '''
+        if self._sprites is None:
+            files = [element + ".png" for element in ELEMENTS.values()]
+            images = dict(zip(ELEMENTS.values(), [self.assets.acquire(file) for file in files]))
+            self._sprites = SpriteCache(images, ELEMENTS.values())
+            # The atlas has its own copy of the pixels
+            for file in files: self.assets.release(file)
+        return self._sprites
+
+    def darkened_sulphur(self):
+        image = self.images['sulphur_b'].copy()
+        image.fill(GREY, None, pygame.BLEND_SUB)
+        return image
+
+    def first_frame(self):
+        '''
+        Called when a screen has been shown. The first time, tell how long
+        the start took if it's over the budget (or always in debug mode).
+        '''
+        if self.started is None: return
+        startup = time.time() - self.started
+        self.started = None
+        if self.debug or startup > STARTUP_BUDGET:
+            print "First frame in %i ms (budget %i ms), %i images loaded" % (
+                startup * 1000, STARTUP_BUDGET * 1000, self.assets.loads)
+
+    def main_menu(self, new_user = False):
         '''
         Load game settings from file.
-        If there are no user profiles, ask user to create one.
-        Load user progress from file.
+        If there are no user profiles, ask user to create one
+        (new_user is True when we come back from that dialog).
+        Load user progress from the profile database.
         Show the main game menu:
              Continue Quest
              New Quest
              Options         - not implemented yet
-             High Scores     - not implemented yet
+             High Scores     - the best runs are on the game screen
              Exit            - not implemented yet
-        User can select another profile here as well (not implemented yet).
+        User can select another profile here as well.
         '''
         
         # Show the background image and the "Alchemy" logo with the shadow
         self.screen.blit(self.images["menu_bg"], (0,0))        
-        logo_l = self.biggest_font.render("Alchemy", 1, WHITE)
-        logo_ls = self.biggest_font.render("Alchemy", 1, GREY)
-        title_l = self.smaller_font.render("In search of the Philosopher's Stone", 1, WHITE)
+        logo_l = self.texts.render(self.biggest_font, "Alchemy", WHITE)
+        logo_ls = self.texts.render(self.biggest_font, "Alchemy", GREY)
+        title_l = self.texts.render(self.smaller_font, "In search of the Philosopher's Stone", WHITE)
         self.screen.blit(logo_ls, (324, 93))
         self.screen.blit(logo_l, (320, 90))
         self.screen.blit(title_l, (345, 190))
         
         # Load main game settings from file
-        settings_file = open("settings", "r")
-        self.settings = json.loads(settings_file.read())
-        settings_file.close()
-        
-        new_user = False
+        self.settings = self.saves.load("settings")
         
         # If there are no user profiles, create one
-        if self.settings["user"] == "None":
-            self.username = self.create_new_user()
-            new_user = True
+        if new_user:
+            pass    # self.username has been set by the dialog
+        elif self.settings["user"] == "None":
+            return (self.create_new_user,)
         else:
             self.username = self.settings["user"]
         
-        # Load user progress file
-        user_file = open("%s_progress" %self.username, "r")
-        self.user = json.loads(user_file.read())
-        user_file.close()
+        # Load user progress, a profile the database doesn't have starts from scratch
+        self.user = self.profiles.load(self.username)
+        if self.user is None:
+            self.user = self.saves.load("progress_init")
+            self.profiles.save(self.username, self.user)
         
         # Construct the main menu: show the menu bg image and some labels
         self.screen.blit(self.images["msg"], (360,340))        
-        new_quest_b = self.big_font.render("New Quest", 1, WHITE)
+        new_quest_b = self.texts.render(self.big_font, "New Quest", WHITE)
         new_quest_b_rect = new_quest_b.get_rect(topleft = (380, 410))
         # If we just created a user profile, "Continue Quest" should look (and be) disabled
         if new_user:
-            continue_quest_b = self.big_font.render("Continue Quest", 1, GREY)
+            continue_quest_b = self.texts.render(self.big_font, "Continue Quest", GREY)
         else:
-            continue_quest_b = self.big_font.render("Continue Quest", 1, WHITE)
+            continue_quest_b = self.texts.render(self.big_font, "Continue Quest", WHITE)
         continue_quest_b_rect = continue_quest_b.get_rect(topleft = (380, 360))        
         self.screen.blit(new_quest_b, new_quest_b_rect)
         self.screen.blit(continue_quest_b, continue_quest_b_rect)
+        # Another user can switch to his own profile
+        other_user_b = self.texts.render(self.smaller_font, "Not %s? Change Magister" % self.username.capitalize(), WHITE)
+        other_user_b_rect = other_user_b.get_rect(topleft = (380, 460))
+        self.screen.blit(other_user_b, other_user_b_rect)
         
         pygame.display.update()
+        self.first_frame()
         
         # Wait for user input
         while True:
-            self.clock.tick(60)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+            for event in self.events.fetch():
+                if event.type == pygame.QUIT:
                     sys.exit()
-            # User can select any menu item
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                if new_quest_b_rect.collidepoint(event.pos):
-                    # User selected "New Quest": reinitialize the user progress file
-                    shutil.copyfile("progress_init", "%s_progress" %self.username)
-                    user_file = open("%s_progress" %self.username, "r")
-                    self.user = json.loads(user_file.read())
-                    user_file.close()
-                    # Set the new username in the game settings file
-                    settings_file = open("settings", "w")
-                    self.settings["user"] = self.username
-                    settings_file.write(json.dumps(self.settings))
-                    settings_file.close()
-                    # Load game
-                    self.game_screen()
-                # New users cannot select "Continue Quest"
-                if continue_quest_b_rect.collidepoint(event.pos) and not new_user:
-                    self.game_screen()
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        sys.exit()
+                # User can select any menu item
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    if new_quest_b_rect.collidepoint(event.pos):
+                        # User selected "New Quest": reinitialize the user progress
+                        # and forget the levels left in the middle
+                        self.user = self.saves.load("progress_init")
+                        self.profiles.save(self.username, self.user)
+                        self.profiles.drop_suspended(self.username)
+                        # Set the new username in the game settings file
+                        self.settings["user"] = self.username
+                        self.saves.save("settings", self.settings)
+                        # Load game
+                        return (self.game_screen,)
+                    # New users cannot select "Continue Quest"
+                    if continue_quest_b_rect.collidepoint(event.pos) and not new_user:
+                        return (self.game_screen,)
+                    if other_user_b_rect.collidepoint(event.pos):
+                        return (self.create_new_user,)
 
     def create_new_user(self):
         '''
         Show a "New user" dialog.
         User can input only latin characters and Backspace.
-        Returns the new username.
+        The recently played profiles are listed below the dialog, a click
+        on one of them (or entering its name) switches to it instead of
+        starting it over.
+        Sets self.username and goes back to the main menu.
         '''
         # Construct the dialog: bg image and OK button
         self.screen.blit(self.images["new_user"], (360,340))
         self.screen.blit(self.images["ok"], (600,390))
+        profile_rects = {}
+        for i, name in enumerate(self.profiles.names(RECENT_PROFILES)):
+            image = self.texts.render(self.smaller_font, name.capitalize(), WHITE)
+            profile_rects[name] = image.get_rect(topleft = (393, 470 + i * 30))
+            self.screen.blit(image, profile_rects[name])
         pygame.display.update()
+        self.first_frame()
         
         # "chars" will hold the characters
         chars = ""
@@ -217,48 +359,57 @@ class Game(object):
         
         # Wait for user input
         while True:
-            self.clock.tick(60)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            
-            # User can quit the game
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+            for event in self.events.fetch():
+                # User can quit the game
+                if event.type == pygame.QUIT:
                     sys.exit()
-                    
-                # User can input any latin characters, but we accept new
-                # characters only if there is enough space for them.
-                if 123 > event.key > 96:
-                    if sum(widths) < 193:
-                        # Force capitalization (Umi, not UMI or uMi, etc)
-                        char = chr(event.key) if chars else chr(event.key).upper()
-                        chars += char
-                        # Create an image for the new char and show it on the screen
-                        char_img = self.smaller_font.render(char, 1, WHITE)
-                        self.screen.blit(char_img, (393 + sum(widths), 397))
-                        pygame.display.update((393 + sum(widths),397, 32, 32))
-                        # Calculate the width of the new image and add store it
-                        widths.append(char_img.get_width()+1)
-                        
-                # User can erase characters: we delete the character and its width
-                # and draw the bg image part over the character image
-                if event.key == pygame.K_BACKSPACE and chars:
-                    chars = chars[:-1]
-                    widths.pop(len(chars))
-                    self.screen.blit(self.images["new_user"], (393 + sum(widths), 397), (33 + sum(widths), 57, 22, 32))
-                    pygame.display.update((393 + sum(widths), 397, 22, 32))
-                    
-            # After user has entered his username he can click "OK"
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                if (self.images["ok"].get_rect(topleft = (600, 390)).collidepoint(event.pos)
-                    and chars):
-                    username = chars.lower()
-                    # Initialize user progress file
-                    shutil.copyfile("progress_init", "%s_progress" %username)
-                    return username
-                    
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        sys.exit()
+
+                    # User can input any latin characters, but we accept new
+                    # characters only if there is enough space for them.
+                    if 123 > event.key > 96:
+                        if sum(widths) < 193:
+                            # Force capitalization (Umi, not UMI or uMi, etc)
+                            char = chr(event.key) if chars else chr(event.key).upper()
+                            chars += char
+                            # Create an image for the new char and show it on the screen
+                            char_img = self.texts.render(self.smaller_font, char, WHITE)
+                            self.screen.blit(char_img, (393 + sum(widths), 397))
+                            pygame.display.update((393 + sum(widths),397, 32, 32))
+                            # Calculate the width of the new image and add store it
+                            widths.append(char_img.get_width()+1)
+
+                    # User can erase characters: we delete the character and its width
+                    # and draw the bg image part over the character image
+                    if event.key == pygame.K_BACKSPACE and chars:
+                        chars = chars[:-1]
+                        widths.pop(len(chars))
+                        self.screen.blit(self.images["new_user"], (393 + sum(widths), 397), (33 + sum(widths), 57, 22, 32))
+                        pygame.display.update((393 + sum(widths), 397, 22, 32))
+
+                # After user has entered his username he can click "OK"
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    if (self.images["ok"].get_rect(topleft = (600, 390)).collidepoint(event.pos)
+                        and chars):
+                        self.username = chars.lower()
+                        if self.profiles.exists(self.username):
+                            return self.switch_user(self.username)
+                        # Initialize user progress
+                        self.profiles.save(self.username, self.saves.load("progress_init"))
+                        return (self.main_menu, True)
+                    for name, rect in profile_rects.items():
+                        if rect.collidepoint(event.pos):
+                            return self.switch_user(name)
+
+    def switch_user(self, name):
+        '''Make an existing profile the current one and go back to the main menu'''
+        self.username = name
+        self.settings["user"] = name
+        self.saves.save("settings", self.settings)
+        return (self.main_menu,)
+
     def game_screen(self):
         '''
         Show the main in-game screen. User can select a level from 
@@ -268,14 +419,14 @@ class Game(object):
         level_image_rects = {}
         self.screen.blit(self.images["menu_bg"], (0,0))
         
-        logo_l = self.biggest_font.render("Alchemy", 1, WHITE)
-        logo_ls = self.biggest_font.render("Alchemy", 1, GREY)
-        title_l = self.smaller_font.render("In search of the Philosopher's Stone", 1, WHITE)
+        logo_l = self.texts.render(self.biggest_font, "Alchemy", WHITE)
+        logo_ls = self.texts.render(self.biggest_font, "Alchemy", GREY)
+        title_l = self.texts.render(self.smaller_font, "In search of the Philosopher's Stone", WHITE)
         self.screen.blit(logo_ls, (324, 93))
         self.screen.blit(logo_l, (320, 90))
         self.screen.blit(title_l, (345, 190))
         
-        welcome_l = self.big_font.render("Welcome, Magister %s!" %self.username.capitalize(), 1, WHITE)
+        welcome_l = self.texts.render(self.big_font, "Welcome, Magister %s!" %self.username.capitalize(), WHITE)
         self.screen.blit(welcome_l, (365, 320))
         
         self.screen.blit(self.images["level_menu"], (360,340))
@@ -283,193 +434,239 @@ class Game(object):
         self.score = self.user["score"]
         self.locked_levels = self.user["locked"]
         
-        score_l = self.smaller_font.render("Score: %i" % self.score, 1, WHITE)
+        score_l = self.texts.render(self.smaller_font, "Score: %i" % self.score, WHITE)
         self.screen.blit(score_l, (20, 760))
 
+        # The best runs of all the levels
+        fame_l = self.texts.render(self.big_font, "Hall of Fame", WHITE)
+        self.screen.blit(fame_l, (40, 340))
+        for place, (player, score) in enumerate(self.highscores.top(GLOBAL, HALL_OF_FAME)):
+            run_l = self.texts.render(self.smaller_font, "%i. %s %i" % (place + 1, player.capitalize(), score), WHITE)
+            self.screen.blit(run_l, (40, 380 + place * 30))
+
         for i in LEVELS:
             if i in self.locked_levels:
-                image = self.smaller_font.render("Level %i" %i, 1, GREY)
+                image = self.texts.render(self.smaller_font, "Level %i" %i, GREY)
             else:
-                image = self.smaller_font.render("Level %i" %i, 1, WHITE)
+                image = self.texts.render(self.smaller_font, "Level %i" %i, WHITE)
             level_image_rects[i] = (image.get_rect(topleft = (380, 320+i*40)))
             self.screen.blit(image, (380, 320+i*40))
+        pygame.display.update()
 
         while True:
-            self.clock.tick(60)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    self.main_menu()
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                for i in LEVELS:
-                    if level_image_rects[i].collidepoint(event.pos):
-                        if not i in self.locked_levels:
-                            level = Level(self, "level_%i" %i)
-                            won, self.score = level.run()
-                            if won:
-                                self.user["score"] = self.score
-                                user_file = open("%s_progress" %self.username, "w")
-                                if i+1 in self.locked_levels:
-                                    self.locked_levels.remove(i+1)
-                                    #self.images['level_%i' %(i+1)].fill(WHITE, None, pygame.BLEND_ADD)
-                                    self.user["locked"] = self.locked_levels
-                                user_file.write(json.dumps(self.user))
-                                user_file.close()
-                            self.game_screen()    
-            pygame.display.update()
+            for event in self.events.fetch():
+                if event.type == pygame.QUIT:
+                    sys.exit()
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        return (self.main_menu,)
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    for i in LEVELS:
+                        if level_image_rects[i].collidepoint(event.pos):
+                            if not i in self.locked_levels:
+                                return (self.play_level, i)
+
+    def play_level(self, i):
+        '''
+        Play level number i. If the user won, save the progress and put
+        the run on the leaderboards.
+        '''
+        level = Level(self, "level_%i" %i)
+        won, self.score = level.run()
+        level.close()
+        if self.debug:
+            print self.texts.stats()
+            # Keep the replay of the last played level, "python replay.py FILE" plays it
+            level.engine.recorder.save("%s_replay" %self.username)
+        # A level left in the middle goes on from there next time
+        if level.suspended:
+            return (self.game_screen,)
+        self.profiles.drop_suspended(self.username, level.level_id)
+        # Every level played goes to the history, the level score is what
+        # was earned on the level itself
+        level_score = level.engine.score - level.init_score
+        self.profiles.record_play(self.username, i, won, level_score)
+        if won:
+            self.user["score"] = self.score
+            if i+1 in self.locked_levels:
+                self.locked_levels.remove(i+1)
+                #self.images['level_%i' %(i+1)].fill(WHITE, None, pygame.BLEND_ADD)
+                self.user["locked"] = self.locked_levels
+            self.profiles.save(self.username, self.user)
+            board = level_board(i)
+            level_rank = self.highscores.add(board, self.username, level_score)
+            global_rank = self.highscores.add(GLOBAL, self.username, level_score)
+            return (level.on_victory, board, level_rank, global_rank)
+        if level.engine.defeat:
+            return (level.on_defeat,)
+        # User left the level
+        return (self.game_screen,)
 
 
 class Level(object):
     def __init__(self, game, level_id):
-        '''Load level details from the text file and initialize level'''
-        # Load the level file
+        '''Load level details from the level pack and initialize level'''
         self.level_id = level_id
-        level_file = open(os.path.join("levels", level_id), "r")
-        level = json.loads(level_file.read())
+        level = game.levels.load(level_id)
         
-        self.clock = pygame.time.Clock()
         self.game = game
         self.screen = self.game.screen
         
         # Load resources: images and fonts
         self.images = self.game.images
-        self.images["bg_image"] = img_load("images", level["bg_image"])
+        self.sprites = self.game.sprites
+        # Backgrounds stay decoded for a while after the level, see AssetCache
+        self.bg_file = level["bg_image"]
+        self.bg_image = self.game.assets.acquire(self.bg_file)
         self.big_font = self.game.big_font
         self.smaller_font = self.game.smaller_font
+        self.texts = self.game.texts
         
         # Get main game parameters
-        self.init_score = self.score = self.game.score 
+        self.init_score = self.game.score
         self.substances = self.game.user["substances"]
-        self.costs = self.game.user["costs"]        
-        # FIXME: Bonus is going to be one of the main game parameters as well
-        self.bonus = 0
-        
-        # Load level parameters
-        self.grid = [[str(cell) for cell in row] for row in level["field"]]
-        self.figure_max_size = level["figure_max_size"]
-        self.elements = level["elements"]
-        self.spoilt = level["spoilt"]
-        self.locked = level["locked"]
-        self.goal = level["goal"]
+        self.costs = self.game.user["costs"]
+
         # When the user reaches some special levels, he automatically researches
         # new substances. Each substance can be researched only once.
-        if "research" in level:
+        # Levels without research have it empty.
+        if level.get("research"):
             self.research = level["research"]
             if self.research not in self.substances:
                 self.substances.append(level["research"])
-                user_file = open("%s_progress" %self.game.username, "w")
-                user_file.write(json.dumps(self.game.user))
-                user_file.close()
+                self.game.profiles.save(self.game.username, self.game.user)
+
+        # A level left in the middle last time goes on from its snapshot
+        self.resumed = self.game.profiles.suspended(self.game.username, level_id)
+        self.suspended = False
+
+        # All the game rules live in the engine, this class only draws them.
+        # Every level gets its own seed and is recorded, so it can be replayed.
+        self.seed = random.randrange(1 << 32)
+        self.engine = Engine(level, self.init_score, self.substances, self.costs,
+                             clock=lambda: pygame.time.get_ticks()/1000,
+                             rng=random.Random(self.seed))
+        self.engine.recorder = Recorder(level_id, self.seed, self.init_score, self.substances, self.costs,
+                                        self.resumed)
+        self.engine.profiler = self.game.profiler
+        # Moves the player can take back, see history.py
+        self.history = History(self.engine)
 
     def run(self):
         '''Game cycle'''
 
-        self.victory = False
-        self.defeat = False
-        
-        self.figure = self.get_next_figure()
-        self.next_figure = self.get_next_figure()
-        self.global_check_place()
-        
-        self.active_subst = ""
-        
+        self.engine.start(self.resumed)
+
         self.set_screen()
-        self.create_figure_img()
-        coords_checked = self.check_place(self.mouse_pos)
+        coords_checked = self.recheck_figure()
         self.update_screen()
-        
-        self.timer_grid = [[0 for cell in row ] for row in self.grid]
-        now = pygame.time.get_ticks()/1000
-        for rnum, row in enumerate(self.grid):
-            for cnum, cell in enumerate(row):
-                if cell <> "0" and cell <> "4" and cell <> "7" and cell <> "b":
-                    self.timer_grid[rnum][cnum] = now + 60 + random.randint(0,5)  
-                          
+
+        profiler = self.game.profiler
         while True:
-            self.clock.tick(90)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            #for event in pygame.event.get():
-                #if event.type == pygame.MOUSEMOTION:
-                    #pygame.event.clear(pygame.MOUSEMOTION)
-                    #pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN])
-                
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
-                    if not self.mouse_visible:
-                        pygame.mouse.set_visible(True)
-                        self.mouse_visible = True
-                    return False, self.init_score
-                
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
-                # Right mouse click rotates the figure
-                if self.grid_area_rect.collidepoint(event.pos):
-                    self.figure = zip(*self.figure[::-1])
-                    self.mouse_pos = event.pos[0] - GRID_OFFSET[0], event.pos[1] - GRID_OFFSET[1]
-                    self.create_figure_img()
-                    coords_checked = self.check_place(self.mouse_pos)
-                    self.update_screen()
-                            
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                # Left mouse click places the figure
-                if self.grid_area_rect.collidepoint(event.pos) and coords_checked:
-                    self.mouse_pos = event.pos[0] - GRID_OFFSET[0], event.pos[1] - GRID_OFFSET[1]
-                    self.place_figure(self.mouse_pos)
-                    coords_checked = self.check_place(self.mouse_pos)
-                    self.update_screen()
-                # User can click one of the substance icons
-                for subst, rect in self.subst_rects.items():
-                    if rect.collidepoint(event.pos):
-                        self.activate_subst(subst, rect)
-                
-            if event.type == pygame.MOUSEMOTION:
-                # Mouse moved above the grid area
-                if self.grid_area_rect.collidepoint(event.pos):
-                    pygame.mouse.set_visible(False)
-                    mouse_visible = False
-                    self.mouse_pos = event.pos[0] - GRID_OFFSET[0], event.pos[1] - GRID_OFFSET[1]
-                    self.create_figure_img()
-                    coords_checked = self.check_place(self.mouse_pos)
-                    self.update_screen()
-                    
-                else:
-                    self.show_grid()
-                    pygame.display.update(self.update_rects)
-                    if not mouse_visible:
-                        pygame.mouse.set_visible(True)
-                        mouse_visible = True
-
-            self.age_metal()
-                
-            if self.victory:
-                self.on_victory()
-                return True, self.score
-                
-            if self.defeat:
-                self.on_defeat()
+            # Wait for events, but not longer than until some metal ages
+            events = self.game.events.fetch(self.aging_timeout())
+            # The rest of the loop is a frame, see profiler.py
+            profiler.start_frame()
+            frame_allocated = allocations.count
+            with profiler.phase("events"):
+                for event in events:
+                    if event.type == pygame.QUIT:
+                        sys.exit()
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_ESCAPE:
+                            if not self.mouse_visible:
+                                pygame.mouse.set_visible(True)
+                                self.mouse_visible = True
+                            self.suspend()
+                            return False, self.init_score
+                        if event.key in SCROLL_KEYS:
+                            coords_checked = self.scroll(*SCROLL_KEYS[event.key])
+                        if event.key in (UNDO_KEY, REDO_KEY) and event.mod & pygame.KMOD_CTRL:
+                            coords_checked = self.undo_move(redo = event.key == REDO_KEY)
+                        if event.key == OVERLAY_KEY:
+                            self.toggle_overlay()
+
+                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 3:
+                        # Right mouse click rotates the figure
+                        if self.grid_area_rect.collidepoint(event.pos):
+                            self.engine.rotate()
+                            self.mouse_pos = self.grid_pos(event.pos)
+                            coords_checked = self.recheck_figure()
+                            self.update_screen()
+
+                    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                        # Left mouse click places the figure
+                        if self.grid_area_rect.collidepoint(event.pos) and coords_checked:
+                            self.mouse_pos = self.grid_pos(event.pos)
+                            self.place_figure(self.mouse_pos)
+                            coords_checked = self.recheck_figure()
+                            self.update_screen()
+                        # User can click one of the substance icons
+                        for subst, rect in self.subst_rects.items():
+                            if rect.collidepoint(event.pos):
+                                self.activate_subst(subst, rect)
+
+                    if event.type == pygame.MOUSEMOTION:
+                        # Mouse moved above the grid area
+                        if self.grid_area_rect.collidepoint(event.pos):
+                            pygame.mouse.set_visible(False)
+                            self.mouse_visible = False
+                            allocated = allocations.count
+                            coords_checked = self.move_figure(event.pos)
+                            # In debug mode make sure that moving the figure allocates nothing
+                            if self.game.debug and allocations.count > allocated:
+                                print "%i surfaces allocated on mouse motion" % (allocations.count - allocated)
+
+                        else:
+                            self.update_screen(show_figure = False)
+                            if not self.mouse_visible:
+                                pygame.mouse.set_visible(True)
+                                self.mouse_visible = True
+
+                    # The rest of the events don't matter if the game is over
+                    if self.engine.victory or self.engine.defeat:
+                        break
+
+            with profiler.phase("age_metal"):
+                self.age_metal()
+            if allocations.enabled: profiler.count("allocations", allocations.count - frame_allocated)
+            profiler.end_frame()
+            self.show_overlay()
+
+            if self.engine.victory:
+                return True, self.engine.score
+
+            if self.engine.defeat:
                 return False, self.init_score
-                #pygame.event.set_allowed([pygame.QUIT, pygame.KEYDOWN, pygame.MOUSEBUTTONDOWN, pygame.MOUSEMOTION])
-    
+
+    def suspend(self):
+        '''
+        Keep the level as it is in the profile, to go on with it next time.
+        A level with no moves made (or all of them taken back) starts anew.
+        '''
+        if self.resumed is None and not self.history.can_undo(): return
+        self.game.profiles.suspend(self.game.username, self.level_id, self.engine.snapshot())
+        self.suspended = True
+
+    def close(self):
+        '''Let go of the level resources, the level isn't played any more'''
+        self.game.assets.release(self.bg_file)
+
     def activate_subst(self, subst, rect):
-        if self.bonus >= self.costs[subst] and not self.active_subst:
+        if self.engine.use_substance(subst):
             print "Activating substance %s" % subst
-            self.active_subst = subst
-            self.bonus -= self.costs[subst]
             self.show_subst()
             self.show_bonus()
-            pygame.display.update(self.update_rects)
+            pygame.display.update(self.pending_rects)
+            self.pending_rects = []
             self.figure_image = {(0, 0): [self.images["sulphur"], [self.mouse_pos[0], self.mouse_pos[1]]]}
             self.shadow = []
+            # The figure is made anew when the mouse moves
+            self.checked_key = None
     
         
-    def on_victory(self):
-        '''Show a "Well done!" message to the user'''
+    def on_victory(self, board, level_rank, global_rank):
+        '''Show a "Well done!" message to the user and the ranks of the run on "board" and overall'''
         
         if not self.mouse_visible:
             pygame.mouse.set_visible(True)
@@ -483,67 +680,28 @@ class Level(object):
         
         # Show the message window and the "Well done!" label
         self.screen.blit(self.images["msg"], (360, 340))
-        win_label = self.big_font.render("Well done!", 1, WHITE)
-        self.screen.blit(win_label, (445, 380))
+        win_label = self.texts.render(self.big_font, "Well done!", WHITE)
+        self.screen.blit(win_label, (445, 365))
+        level_rank_l = self.texts.render(self.smaller_font, "Level rank: %i of %i" % (
+            level_rank, self.game.highscores.size(board)), WHITE)
+        self.screen.blit(level_rank_l, (390, 400))
+        global_rank_l = self.texts.render(self.smaller_font, "Overall rank: %i of %i" % (
+            global_rank, self.game.highscores.size(GLOBAL)), WHITE)
+        self.screen.blit(global_rank_l, (390, 425))
         
         pygame.display.update()
         
         # Wait for the user's input
         while True:
-            self.clock.tick(60)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+            for event in self.game.events.fetch():
+                if event.type == pygame.QUIT:
                     sys.exit()
-            # Left mouse click returns us to the games screen
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                return
-                    
-    def get_next_figure(self):
-        '''
-        Generate a new figure.
-        This function is called from self.run() to generate 2 initial figures
-        and then from self.place_figure() every time we need a new figure.
-        '''
-        
-        # Based on size of the figure and number of rows get number of cols and empty cells.
-        # FIXME: Sometimes this algorithm generates wrong polyominoes (with non-adjacent cells)
-        size = random.randint(1, self.figure_max_size)
-        rows = random.randint(1, size)
-         
-        if rows == size: cols = 1
-        elif size == 4:
-            if rows == 3: cols = 2
-            elif rows == 2: cols = random.choice((2, 3))
-            else: cols = 4
-        elif size == 3:
-            if rows == 2: cols = 2
-            else: cols = 3
-        elif size == 2: cols = 2
- 
-        empty = cols * rows - size
-        
-        next_figure = [["" for col in range(cols)] for row in range(rows)]
-        
-        # Generate cells (including empties) for the next figure and store them in a temporary array
-        temp_arr = [random.choice(self.elements) for i in range(size)]
-        for i, element in enumerate(temp_arr):
-            if element in self.spoilt:
-                temp_arr[i] = random.choice((element, element+"s"))
-        temp_arr.extend([""] * empty)
-        
-        # Generate the next figure
-        for row in range(rows):
-            for col in range(cols):
-                cell = random.choice(temp_arr)
-                temp_arr.remove(cell)
-                next_figure[row][col] = cell
-                
-        return next_figure
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        sys.exit()
+                # Left mouse click returns us to the games screen
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    return (self.game.game_screen,)
 
     def on_defeat(self):
         '''Show a "Try again!" message to the user'''
@@ -560,84 +718,84 @@ class Level(object):
         
         # Show the message window and the "Try again!" label
         self.screen.blit(self.images["msg"], (360, 340))
-        win_label = self.big_font.render("Try again!", 1, WHITE)
+        win_label = self.texts.render(self.big_font, "Try again!", WHITE)
         self.screen.blit(win_label, (445, 380))
         
         pygame.display.update()
         
         # Wait for the user's input
         while True:
-            self.clock.tick(60)
-            event = pygame.event.poll()
-            pygame.event.clear()
-            
-            if event.type == pygame.QUIT:
-                sys.exit()
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+            for event in self.game.events.fetch():
+                if event.type == pygame.QUIT:
                     sys.exit()
-            # Left mouse click returns us to the games screen
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                return
- 
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        sys.exit()
+                # Left mouse click returns us to the games screen
+                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                    return (self.game.game_screen,)
+
     def set_screen(self):
         '''Set screen for current level'''
-        self.update_rects = []
-        self.screen.blit(self.images["bg_image"], (0, 0))
-        self.screen.blit(self.images['grid_border'], (GRID_OFFSET[0]-32, GRID_OFFSET[1]-32))
+        # Screen rects changed outside the grid since the last display update
+        self.pending_rects = []
+        self.grid_renderer = GridRenderer(self.screen, self.images, self.engine.board, GRID_AREA)
+        self.grid_area_rect = self.grid_renderer.rect
         
-        self.grid_area = self.images['grid'].copy()
-        self.grid_area_rect = self.grid_area.get_rect(topleft = GRID_OFFSET)
-        self.update_rects.append(self.grid_area_rect)
+        background = self.grid_renderer.background(self.bg_image, self.images['grid_border'])
+        self.screen.blit(background, (0, 0))
         self.show_grid()
         
-        next_label = self.big_font.render("Next:", 1, WHITE)
+        next_label = self.texts.render(self.big_font, "Next:", WHITE)
         self.screen.blit(next_label, (20, 10))
         
-        self.next_area = pygame.Surface((128, 128))
-        self.update_rects.append(self.next_area.get_rect(topleft = NEXT_OFFSET))
+        self.next_area = allocations.new((128, 128))
         self.show_next()
         
-        goal_label = self.big_font.render("Metals to transmute:", 1, WHITE)
+        goal_label = self.texts.render(self.big_font, "Metals to transmute:", WHITE)
         self.screen.blit(goal_label, (20, 170))
         self.show_goal()
         
-        score_l = self.smaller_font.render("Score: %i" % self.score, 1, WHITE)
+        score_l = self.texts.render(self.smaller_font, "Score: %i" % self.engine.score, WHITE)
         self.screen.blit(score_l, (20, 760))
-        bonus_l = self.smaller_font.render("Bonus: %i" % self.bonus, 1, WHITE)
+        bonus_l = self.texts.render(self.smaller_font, "Bonus: %i" % self.engine.bonus, WHITE)
         self.screen.blit(bonus_l, (900, 760))
-        self.update_rects.append((20, 760, 120, 25))
-        self.update_rects.append((900, 760, 120, 25))
         
+        self.subst_rects = {}
         if self.substances:
-            subst_l = self.big_font.render("Substances:", 1, WHITE)
+            subst_l = self.texts.render(self.big_font, "Substances:", WHITE)
             self.screen.blit(subst_l, (840, 170))
-            self.subst_rects = {}
             for i, subst in enumerate(self.substances):
                 self.subst_rects[subst] = pygame.Rect(840, 210 + i * 120, 64, 64)
-                self.update_rects.append((840, 210 + i * 120, 64, 64))
             print self.subst_rects
             self.show_subst()
      
+        # The overlay is drawn with the first frame if it's on
+        self.overlay_shown = None
+        
         init_mouse = pygame.mouse.get_pos()
+        self.mouse_visible = True
+        self.mouse_pos = (0, 0)
         
         if self.grid_area_rect.collidepoint(init_mouse):
             pygame.mouse.set_visible(False)
             self.mouse_visible = False
-            self.mouse_pos = init_mouse[0] - GRID_OFFSET[0], init_mouse[1] - GRID_OFFSET[1]
+            self.mouse_pos = self.grid_pos(init_mouse)
 
         pygame.display.update()
+        self.pending_rects = []
        
     def create_figure_img(self):
         '''
         Create a dict containing images for every cell of the figure and their
         coordinates in order to blit all cell images when updating screen.
+        Images come from the sprite cache, nothing is copied here.
         '''
         self.figure_image = {}
-        for rnum, c_row in enumerate(self.figure):
+        for rnum, c_row in enumerate(self.engine.figure):
             for cnum, cell in enumerate(c_row):
                 if cell:
-                    cell_image = self.images[ELEMENTS[cell]].copy()
+                    cell_image = self.sprites.sprite(ELEMENTS[cell])
                 else: continue       # No need to check an empty cell
                 self.figure_image[rnum, cnum] = [cell_image, [self.mouse_pos[0] + cnum*32, self.mouse_pos[1] + rnum*32]]
         self.shadow = []
@@ -650,188 +808,209 @@ class Level(object):
         '''
         row, col = self.get_row_col(pos)
         
-        check_results = []
+        check_results = self.engine.check_place(row, col)
         
-        for rnum, c_row in enumerate(self.figure):
-            for cnum, cell in enumerate(c_row):
-                if not cell: continue       # No need to check an empty cell
-                try:
-                    if self.grid[row + rnum][col + cnum] == "0":
-                        check_results.append(True)
-                        self.shadow.append(((col+cnum)*32, (row+rnum)*32))
-                    else:
-                        check_results.append(False)
-                        self.figure_image[rnum, cnum][0].fill((50, 50,50), None, pygame.BLEND_SUB)
-                except IndexError:
-                    check_results.append(False)
-
-        coords_checked = all(check_results)
+        for (rnum, cnum), fits in check_results.items():
+            if fits:
+                self.shadow.append(self.grid_renderer.cell_pos(row+rnum, col+cnum))
+            else:
+                cell = self.engine.figure[rnum][cnum]
+                self.figure_image[rnum, cnum][0] = self.sprites.sprite(ELEMENTS[cell], blocked = True)
+
+        coords_checked = all(check_results.values())
         return coords_checked       
-    
-    def global_check_place(self):
+
+    def recheck_figure(self):
         '''
-        Check if there is enough free space on the grid for current figure.
-        If not, user lost this game.
+        Make the figure images and check the figure at the mouse position
+        from scratch. Returns whether the figure fits there.
         '''
+        self.create_figure_img()
+        self.coords_checked = self.check_place(self.mouse_pos)
+        # Cell and rotation the check was made for, see move_figure()
+        self.checked_key = self.get_row_col(self.mouse_pos) + (self.engine.rotation,)
+        return self.coords_checked
 
-        # Store all possible rotations of the figure in a list
-        rotations = [self.figure]
-        for i in range(3):
-            rotations.append(zip(*rotations[i][::-1]))
-        
-        # We look for a place for any rotation of the figure
-        for figure in rotations:
-            # These two loops iterate through the grid
-            for g_rnum, gc_row in enumerate(self.grid):
-                for g_cnum, g_cell in enumerate(gc_row):
-                    
-                    check_results = []
-                    
-                    # These two loops iterate through current figure, cell by cell.
-                    # Results are stored in check_results.
-                    for rnum, c_row in enumerate(figure):
-                        for cnum, cell in enumerate(c_row):
-                            if not cell: continue       # No need to check an empty cell
-                            try:
-                                if self.grid[g_rnum + rnum][g_cnum + cnum] == "0":
-                                    check_results.append(True)
-                                else:
-                                    check_results.append(False)
-                            except IndexError:
-                                check_results.append(False)
-                    
-                    # Check if all cells of current figure can be placed in current position of the grid.
-                    # If yes, then there is no need to check any other rotation or positions.
-                    can_place = all(check_results)
-                    if can_place:
-                        return
-        
-        # If we did not return at some point then no place was found for current figure => the game is lost
-        self.defeat = True
+    def move_figure(self, pos):
+        '''
+        Follow the mouse, moved to "pos" over the grid, with the figure.
+        The figure is only checked again when it is over another cell or
+        rotated since the last check. Within the same cell the shadow and
+        the darkened figure cells stay as they are and only the figure
+        images move with the mouse.
+        Returns whether the figure fits.
+        '''
+        self.mouse_pos = self.grid_pos(pos)
+        key = self.get_row_col(self.mouse_pos) + (self.engine.rotation,)
+        if key != self.checked_key:
+            self.recheck_figure()
+        else:
+            for (rnum, cnum), image in self.figure_image.items():
+                image[1][0] = self.mouse_pos[0] + cnum * 32
+                image[1][1] = self.mouse_pos[1] + rnum * 32
+        self.update_screen()
+        return self.coords_checked
     
-    def update_screen(self):
+    def update_screen(self, show_figure = True):
         '''
         Update the grid, the figure image and its shadow.
         This function is called every time the user moves or left-clicks
         his mouse or rotates the figure.
         It is also called before the game loop (right after the screen
         has been set), and from self.age_metal().
+        Only the cells that changed are redrawn, see GridRenderer.
         '''
-        # Update the grid area
-        self.show_grid()
+        profiler = self.game.profiler
+        with profiler.phase("render"):
+            if show_figure:
+                rects = self.grid_renderer.render(self.shadow, self.figure_image)
+            else:
+                rects = self.grid_renderer.render()
 
-        # Show the shadow of the current figure
-        for coords in self.shadow:
-            self.grid_area.blit(self.images['shadow'], coords)
+            profiler.count("blits", self.grid_renderer.blits)
+            profiler.count("rects", len(rects) + len(self.pending_rects))
+            pygame.display.update(rects + self.pending_rects)
+            self.pending_rects = []
 
-        # Show the figure
-        for cell in self.figure_image.values():
-            self.grid_area.blit(*cell)
-        self.screen.blit(self.grid_area, GRID_OFFSET)
+    def place_figure(self, pos):
+        '''
+        Place the figure on the grid (the engine handles matches and
+        generates the next figure) and show the next figure in the next_area.
+        The new figure is made by recheck_figure() afterwards.
+        '''
+        with self.game.profiler.phase("place"):
+            row, col = self.get_row_col(pos)
+            self.history.begin()
+            self.engine.place(row, col)
+            self.history.commit()
+            
+            # Update visuals
+            if self.engine.matched:
+                self.show_goal()
+                self.show_score()
+                self.show_bonus()
+                self.show_subst()
+            self.show_next()
 
-        pygame.display.update(self.update_rects)
+    def undo_move(self, redo = False):
+        '''
+        Take the last move back (or make the last move taken back again)
+        and show the level as it is then. Returns whether the figure fits
+        at the mouse position.
+        '''
+        if redo: done = self.history.redo()
+        else: done = self.history.undo()
+        if done:
+            self.show_goal()
+            self.show_score()
+            self.show_bonus()
+            self.show_subst()
+            self.show_next()
+        coords_checked = self.recheck_figure()
+        self.update_screen(show_figure = not self.mouse_visible)
+        return coords_checked
 
-    def place_figure(self, pos):
+    def toggle_overlay(self):
+        '''Show or hide the performance overlay'''
+        self.game.overlay = not self.game.overlay
+        self.overlay_shown = None
+        if not self.game.overlay:
+            self.screen.blit(self.bg_image, OVERLAY_RECT, OVERLAY_RECT)
+            pygame.display.update(OVERLAY_RECT)
+
+    def show_overlay(self):
         '''
-        Add the new values to the grid, handle matches for the new values, generate
-        the next figure and show it in the next_area
+        Show frames per second, the 99th percentile of frame time and the
+        phase of the frame that takes longest, if the overlay is on.
+        It's redrawn every OVERLAY_PERIOD seconds at most.
         '''
-        row, col = self.get_row_col(pos)
-        
-        # Update grid values
-        for rnum, c_row in enumerate(self.figure):
-            for cnum, cell in enumerate(c_row):
-                if cell: 
-                    self.grid[row + rnum][col + cnum] = cell
-                    if cell <> "4" and cell <> "7":
-                        self.timer_grid[row + rnum][col + cnum] = pygame.time.get_ticks()/1000 + 60
-                    
-        # Find and destroy matches for every cell of the figure
-        for rnum, c_row in enumerate(self.figure):
-            for cnum, cell in enumerate(c_row):
-                if cell: self.handle_matches(row + rnum, col + cnum, cell)
-                
-        # Generate a new figure
-        self.figure = self.next_figure
-        self.create_figure_img()
-        self.next_figure = self.get_next_figure()
-        
-        # Check if the new figure can be placed anywhere
-        self.global_check_place()
-        
-        # Update visuals
-        self.show_next()
+        if not self.game.overlay: return
+        if self.overlay_shown is not None and time.time() < self.overlay_shown + OVERLAY_PERIOD: return
+        # Drawn after the frame, so it doesn't count in the numbers it shows
+        profiler = self.game.profiler
+        self.overlay_shown = time.time()
+        lines = ["FPS: %i" % profiler.fps(),
+                 "Frame p99, us: %i" % (profiler.frames.percentile(99) * 1e6)]
+        slowest = profiler.slowest()
+        if slowest:
+            lines.append("Slowest %s, us: %i" % (slowest[0], slowest[1] * 1e6))
+        self.screen.blit(self.bg_image, OVERLAY_RECT, OVERLAY_RECT)
+        for i, line in enumerate(lines):
+            self.screen.blit(self.texts.render(self.smaller_font, line, WHITE),
+                             (OVERLAY_RECT.left, OVERLAY_RECT.top + i * 25))
+        pygame.display.update(OVERLAY_RECT)
     
     def age_metal(self):
         '''
         Check if one or more pieces of metal aged. 
-        If yes, update the timers and the screen.
-        '''
-        changed = False
-        now = pygame.time.get_ticks()/1000
-        for rnum, row in enumerate(self.timer_grid):
-            for cnum, cell in enumerate(row):
-                if cell and cell <= now:
-                    if self.grid[rnum][cnum][-1] <> "s" and self.grid[rnum][cnum] <> "o" and self.grid[rnum][cnum] <> "b":
-                        self.grid[rnum][cnum] = self.grid[rnum][cnum] + "s"
-                        self.timer_grid[rnum][cnum] = now + 60 + random.randint(0,5)
-                    else:
-                        self.grid[rnum][cnum] = "o" 
-                        self.timer_grid[rnum][cnum] = 0
-                    changed = True
-        if changed: self.update_screen()
+        If yes, update the screen.
+        '''
+        if self.engine.tick(): self.update_screen()
+
+    def aging_timeout(self):
+        '''Milliseconds until the next piece of metal ages, None if no metal is aging'''
+        deadline = self.engine.next_deadline()
+        if deadline is None: return None
+        return max(0, deadline * 1000 - pygame.time.get_ticks())
     
-    @staticmethod
-    def get_row_col(pos):
+    def grid_pos(self, pos):
+        '''Screen position relative to the grid view'''
+        return pos[0] - self.grid_renderer.offset[0], pos[1] - self.grid_renderer.offset[1]
+
+    def get_row_col(self, pos):
         '''Return row and column numbers for current mouse position'''
-        col, row = (pos[0]+16)/32, (pos[1]+16)/32
-        return row, col
+        return self.grid_renderer.cell_at((pos[0]+16, pos[1]+16))
+
+    def scroll(self, d_rows, d_cols):
+        '''
+        Scroll the grid view and check the figure at its new place on the board.
+        Returns whether the figure fits there.
+        '''
+        if self.grid_renderer.scroll(d_rows, d_cols):
+            self.show_grid()
+        coords_checked = self.recheck_figure()
+        self.update_screen(show_figure = not self.mouse_visible)
+        return coords_checked
 
     def show_goal(self):
         '''Update screen in the goal area''' 
         goal_labels = []
         # Create labels for the level goal
-        for metal, quantity in self.goal.items():
+        for metal, quantity in self.engine.goal.items():
             goal_label = "%s: %i" %(ELEMENTS[metal].capitalize(), quantity)
-            goal_labels.append(self.smaller_font.render(goal_label, 1, WHITE))
+            goal_labels.append(self.texts.render(self.smaller_font, goal_label, WHITE))
         # Show labels
         for i, label in enumerate(goal_labels):
-            self.screen.blit(self.images["bg_image"], (20, 205 + i*25), (20, 205 + i*25, 120, 25))
+            self.screen.blit(self.bg_image, (20, 205 + i*25), (20, 205 + i*25, 120, 25))
             self.screen.blit(label, (20, 205 + i*25))
-            rect = (20, 205 + i*25, 120, 25)
-            if rect not in self.update_rects: self.update_rects.append(rect)
+            self.pending_rects.append((20, 205 + i*25, 120, 25))
         
     def show_score(self):
-        score_l = self.smaller_font.render("Score: %i" % self.score, 1, WHITE)
-        self.screen.blit(self.images["bg_image"], (20, 760), (20, 760, 120, 25))
+        score_l = self.texts.render(self.smaller_font, "Score: %i" % self.engine.score, WHITE)
+        self.screen.blit(self.bg_image, (20, 760), (20, 760, 120, 25))
         self.screen.blit(score_l, (20, 760))
+        self.pending_rects.append((20, 760, 120, 25))
     
     def show_bonus(self):
-        bonus_l = self.smaller_font.render("Bonus: %i" % self.bonus, 1, WHITE)
-        self.screen.blit(self.images["bg_image"], (900, 760), (900, 760, 120, 25))
+        bonus_l = self.texts.render(self.smaller_font, "Bonus: %i" % self.engine.bonus, WHITE)
+        self.screen.blit(self.bg_image, (900, 760), (900, 760, 120, 25))
         self.screen.blit(bonus_l, (900, 760))
+        self.pending_rects.append((900, 760, 120, 25))
         
     
     def show_next(self):
         '''Update screen in the next figure area'''
         self.next_area.fill((0,0,0))
-        for rnum, c_row in enumerate(self.next_figure):
+        for rnum, c_row in enumerate(self.engine.next_figure):
             for cnum, cell in enumerate(c_row):
                 if cell:
                     self.next_area.blit(self.images[ELEMENTS[cell]], (cnum*32,rnum*32))
                     self.screen.blit(self.next_area, NEXT_OFFSET)
+        self.pending_rects.append(self.next_area.get_rect(topleft = NEXT_OFFSET))
 
     def show_grid(self):
-        '''Update screen in the grid area cell by cell'''
-        for rnum, row in enumerate(self.grid):
-            for cnum, cell in enumerate(row):
-                if cell == "0":
-                    self.grid_area.blit(self.images['grid'], (cnum * 32, rnum * 32), (cnum * 32, rnum * 32, 32, 32))
-                elif cell == "b":
-                    self.grid_area.blit(self.images["border"], (cnum * 32, rnum * 32))
-                else:                    
-                    self.grid_area.blit(self.images[ELEMENTS[cell]], (cnum * 32, rnum * 32))
-        self.screen.blit(self.grid_area, GRID_OFFSET)
+        '''Redraw the whole grid area cell by cell'''
+        self.pending_rects.extend(self.grid_renderer.redraw())
     
     def show_subst(self):
         '''
@@ -840,102 +1019,32 @@ class Level(object):
         '''
         for i, subst in enumerate(self.substances):
             # Substance icons may be normal or dark (not enough bonus)
-            if self.bonus >= self.costs[subst]:
+            if self.engine.bonus >= self.costs[subst]:
                 self.screen.blit(self.images["%s_b" % subst], (840, 210 + i * 120))
             else:
                 self.screen.blit(self.images["%s_bd" % subst], (840, 210 + i * 120))
-        
-    def handle_matches(self, row, col, cell):
-        '''Find all matches with the current cell and destroy all matching cells'''
-        
-        def check_dir(row, col, dir, cell, counter, d_coords):
-            '''
-            Check the next cell in given direction. If it has the same color as the current cell,
-            store its coords (to delete it later) and pass it to this function recursively
-            with an incremented counter
-            '''
-            n_row = row + dir[0]
-            n_col = col + dir[1]            
-            
-            # We don't want to get outside of our grid
-            if not (n_row < 0 or n_col < 0 or n_row >= len(self.grid) or n_col >= len(self.grid)):
-                # If the last character is "l" (which indicates a locked cell)
-                # then there's no match for sure
-                if self.grid[n_row][n_col][-1] == "l" or cell[-1] == "l":
-                    return counter, d_coords
-                # We compare only the first character, so that "1" and "1s"
-                # (which are mercury and spoilt mercury) will make a match
-                if self.grid[n_row][n_col][0] == cell[0]:
-                    d_coords.append([n_row, n_col])
-                    counter += 1
-                    counter, d_coords = check_dir(n_row, n_col, dir, cell, counter, d_coords)
-            return counter, d_coords
-
-        up = -1, 0
-        down = 1, 0
-        left = 0, -1
-        right = 0, 1 
-                
-        match_found = False
-        
-        # Check adjacent cells in vertical direction (up, then down)
-        counter = 0
-        d_coords = []
-       
-        counter, d_coords = check_dir(row, col, up, cell, counter, d_coords)
-        counter, d_coords  = check_dir(row, col, down, cell, counter, d_coords)
-
-        if counter >= 2: 
-            match_found = True
-            element = cell[0]
-            if element in self.goal:
-                if self.goal[element] <= 0:
-                    self.goal[element] = 0
-                else:
-                    self.goal[element] -=1
-            for d_row, d_col in d_coords: 
-                self.grid[d_row][d_col] = "0"
-                self.timer_grid[d_row][d_col] = 0
-            
-            self.score += 5 * counter
-            self.bonus += counter - 2
-            
+            self.pending_rects.append((840, 210 + i * 120, 64, 64))
 
-        # Check adjacent cells in horizontal direction (left, then right)
-        counter = 0
-        d_coords = []
-
-        counter, d_coords = check_dir(row, col, left, cell, counter, d_coords)
-        counter, d_coords = check_dir(row, col, right, cell, counter, d_coords)
-
-        if counter >= 2:
-            element = cell[0]
-            match_found = True
-            if element in self.goal:
-                if self.goal[element] <= 0:
-                    self.goal[element] = 0
-                else:
-                    self.goal[element] -=1
-            for d_row, d_col in d_coords:
-                self.grid[d_row][d_col] = "0"         
-                self.timer_grid[d_row][d_col] = 0
-
-            self.score += 5 * counter
-            self.bonus += counter - 2
-
-                                
-        # If there was a match, destroy the cell itself
-        if match_found: 
-            self.grid[row][col] = "0"
-            self.timer_grid[row][col] = 0
-            self.show_goal()
-            self.show_score()
-            self.show_bonus()
-            self.show_subst()
-            if all([quantity == 0 for quantity in self.goal.values()]): self.victory = True
-                                    
 def main():
-    game = Game()
+    # "alchemy.py simulate ..." plays levels headlessly, see simulate.py
+    if sys.argv[1:2] == ["simulate"]:
+        import simulate
+        simulate.main(sys.argv[2:])
+        return
+    # "alchemy.py generate ..." makes new levels, see generate.py
+    if sys.argv[1:2] == ["generate"]:
+        import generate
+        generate.main(sys.argv[2:])
+        return
+    # Count surface allocations in debug mode, or when profiling to a trace
+    # file (alchemy.py --trace FILE)
+    debug = "--debug" in sys.argv
+    trace = None
+    if "--trace" in sys.argv[:-1]:
+        trace = sys.argv[sys.argv.index("--trace") + 1]
+    if debug or trace: allocations.enabled = True
+    game = Game(debug, trace)
+    game.run()
     
 if __name__ == '__main__':
 	main()
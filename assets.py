@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+#       Image loading for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Images are loaded when they are first needed, not at startup.
+
+AssetCache decodes every file once and counts who uses it, Images gives
+the rest of the game the usual "images by name" dict on top of it.
+'''
+
+import os.path
+
+import pygame
+
+
+class AssetCache(object):
+    '''
+    Decoded image files, loaded on first use and shared by file name.
+
+    get() loads a file for good. acquire() and release() count the users of
+    a file instead: a file nobody uses any more stays decoded (so coming back
+    to the same level costs nothing) until "keep" other files have been
+    released after it.
+    '''
+    def __init__(self, directory, keep = 4):
+        self.directory = directory
+        self.keep = keep
+        # file -> surface
+        self.surfaces = {}
+        # file -> number of users, for the files that are acquired
+        self.users = {}
+        # Files without users, the least recently released first
+        self.unused = []
+        # Number of files decoded so far
+        self.loads = 0
+
+    def load(self, file):
+        '''Decode an image file'''
+        self.loads += 1
+        return pygame.image.load(os.path.join(self.directory, file)).convert_alpha()
+
+    def get(self, file):
+        if file not in self.surfaces:
+            self.surfaces[file] = self.load(file)
+        return self.surfaces[file]
+
+    def acquire(self, file):
+        '''Get a file and count one more user of it'''
+        surface = self.get(file)
+        self.users[file] = self.users.get(file, 0) + 1
+        if file in self.unused: self.unused.remove(file)
+        return surface
+
+    def release(self, file):
+        '''One user of a file doesn't need it any more'''
+        self.users[file] -= 1
+        if self.users[file] > 0: return
+        del self.users[file]
+        self.unused.append(file)
+        while len(self.unused) > self.keep:
+            del self.surfaces[self.unused.pop(0)]
+
+
+class Images(object):
+    '''
+    Images by name, loaded on first use. A name stands either for a file
+    in the asset cache or for a function making the image.
+    '''
+    def __init__(self, assets):
+        self.assets = assets
+        # name -> file name or function
+        self.sources = {}
+        self.images = {}
+
+    def add(self, name, source):
+        self.sources[name] = source
+
+    def __contains__(self, name):
+        return name in self.sources
+
+    def __getitem__(self, name):
+        if name not in self.images:
+            source = self.sources[name]
+            if callable(source): self.images[name] = source()
+            else: self.images[name] = self.assets.get(source)
+        return self.images[name]
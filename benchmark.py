@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+#
+#       Benchmarks for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Timing of the hot paths of the game.
+
+    python benchmark.py boards [-n PLACEMENTS] [ROWSxCOLS ...]
+    python benchmark.py levels [-n EVENTS] [-o FILE] [-c FILE] [LEVEL ...]
+
+"boards" makes random placements on random boards of growing size and
+prints the median cost of a placement (matches included), of finding the
+matches alone and of the legal move checks: whether the figure fits at the
+mouse position and whether it fits anywhere. None of them should grow with
+the board.
+
+"levels" plays the shipped levels in the real game window (the SDL dummy
+video driver is used unless SDL_VIDEODRIVER says otherwise). A seeded
+script of mouse motion, rotations and clicks is fed to Level.run() as if
+it came from the user, and the cost of every event and of the Level and
+Engine methods it goes through is measured: latency percentiles and
+operations per second. The results can be saved as JSON (-o) and compared
+with an earlier run (-c), which flags the operations that got slower.
+'''
+
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+
+from board import BORDER, FREE
+from engine import Engine, ManualClock
+
+BOARD_SIZES = ((15, 15), (50, 50), (100, 100), (200, 200), (15, 200), (200, 15))
+
+LEVELS = (1, 2, 3, 4, 5)
+
+# Methods timed by the "levels" benchmark, on the Level and on its Engine
+LEVEL_METHODS = ("check_place", "create_figure_img", "update_screen", "show_grid", "age_metal")
+ENGINE_METHODS = ("global_check_place", "handle_matches")
+
+# Share of the scripted events that are rotations and clicks, the rest is mouse motion
+ROTATE_SHARE = 0.1
+PLACE_SHARE = 0.1
+
+# An operation is reported as slower than in the compared run if its median
+# grew by more than this, and it was measured at least REGRESSION_COUNT times
+REGRESSION = 0.2
+REGRESSION_COUNT = 20
+
+
+def random_level(rows, cols, seed = 0, density = 0.4):
+    '''A level with a random field, "density" of its cells taken'''
+    rng = random.Random(seed)
+    elements = ["1", "2", "3", "4"]
+    field = []
+    for row in range(rows):
+        field.append([])
+        for col in range(cols):
+            if rng.random() < density: field[-1].append(rng.choice(elements + [BORDER]))
+            else: field[-1].append(FREE)
+    return {
+        "height": rows,
+        "width": cols,
+        "field": field,
+        "elements": elements,
+        "spoilt": ["1"],
+        "locked": [],
+        "figure_max_size": 4,
+        # Never won, so the level goes on as long as there is space
+        "goal": {"1": 1 << 30},
+        }
+
+
+def timed(function, times):
+    '''Wrap a function so that the duration of every call is appended to "times"'''
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        result = function(*args, **kwargs)
+        times.append(time.time() - start)
+        return result
+    return wrapper
+
+
+def percentile(times, percent):
+    if not times: return 0.0
+    times = sorted(times)
+    return times[min(len(times) - 1, len(times) * percent // 100)]
+
+
+def median(times):
+    return percentile(times, 50)
+
+
+def summary(times):
+    '''Latency percentiles (in seconds) and throughput of an operation'''
+    total = sum(times)
+    return {
+        "count": len(times),
+        "p50": percentile(times, 50),
+        "p90": percentile(times, 90),
+        "p99": percentile(times, 99),
+        "max": max(times or [0.0]),
+        "ops_per_sec": len(times) / total if total else 0.0,
+        }
+
+
+def bench_board(rows, cols, placements = 500, seed = 0):
+    '''
+    Make "placements" random placements on a rows x cols board, starting
+    over on a new random board whenever there's no space left.
+    Returns {operation: median seconds}.
+    '''
+    times = {"place": [], "matches": [], "can_place": [], "fits_anywhere": []}
+    rng = random.Random(seed)
+    engine = None
+    done = 0
+    while done < placements:
+        if engine is None or engine.defeat:
+            engine = Engine(random_level(rows, cols, seed + done), clock = ManualClock(),
+                            rng = random.Random(seed + done))
+            engine.start()
+            engine.handle_matches = timed(engine.handle_matches, times["matches"])
+            engine.board.fits_anywhere = timed(engine.board.fits_anywhere, times["fits_anywhere"])
+
+        # The mouse is somewhere over the board
+        can_place = timed(engine.can_place, times["can_place"])
+        spots = [(rng.randrange(rows), rng.randrange(cols)) for i in range(20)]
+        spots = [(row, col) for row, col in spots if can_place(row, col)]
+        if not spots:
+            # Hard to hit a free spot by chance, take any (not timed)
+            spots = engine.board.cells(engine.board.placements(engine.figure))
+            if not spots:
+                engine.rotate()
+                continue
+        row, col = rng.choice(spots)
+        timed(engine.place, times["place"])(row, col)
+        done += 1
+    result = {}
+    for operation, op_times in times.items():
+        result[operation] = median(op_times)
+    return result
+
+
+def boards(sizes, placements):
+    operations = ("place", "matches", "can_place", "fits_anywhere")
+    print "%-9s " % "board" + " ".join(["%13s" % operation for operation in operations])
+    for rows, cols in sizes:
+        result = bench_board(rows, cols, placements)
+        print "%-9s " % ("%ix%i" % (rows, cols)) + \
+            " ".join(["%10.1f us" % (result[operation] * 1e6) for operation in operations])
+
+
+class ScriptedEvents(object):
+    '''
+    Stands for the game's EventDispatcher: hands out the events of a script
+    one at a time, and times how long the level took to handle each of them
+    (until it asked for the next one). Once the script is over, every fetch
+    gets Escape, which leaves the level.
+    '''
+    def __init__(self, script, times):
+        self.script = script
+        self.position = 0
+        # event kind -> list of durations
+        self.times = times
+        self.kind = None
+        self.started = None
+
+    def restart(self):
+        '''A new level starts, its setup doesn't count as handling an event'''
+        self.kind = None
+
+    def done(self):
+        return self.position >= len(self.script)
+
+    def fetch(self, timeout = None):
+        if self.kind is not None:
+            self.times[self.kind].append(time.time() - self.started)
+            self.kind = None
+        if self.done():
+            import pygame
+            return [pygame.event.Event(pygame.KEYDOWN, key = pygame.K_ESCAPE)]
+        self.kind, event = self.script[self.position]
+        self.position += 1
+        self.started = time.time()
+        return [event]
+
+
+def event_script(area, count, seed):
+    '''
+    "count" events of a mouse wandering over the screen area of the grid
+    (and a bit off it), sometimes rotating or placing the figure.
+    A list of (kind, event).
+    '''
+    import pygame
+    rng = random.Random(seed)
+    x, y = area.center
+    script = []
+    for i in range(count):
+        roll = rng.random()
+        if roll < ROTATE_SHARE:
+            script.append(("rotate", pygame.event.Event(pygame.MOUSEBUTTONDOWN, button = 3, pos = (x, y))))
+        elif roll < ROTATE_SHARE + PLACE_SHARE:
+            script.append(("place", pygame.event.Event(pygame.MOUSEBUTTONDOWN, button = 1, pos = (x, y))))
+        else:
+            d_x, d_y = rng.randint(-24, 24), rng.randint(-24, 24)
+            x = min(max(x + d_x, area.left - 40), area.right + 40)
+            y = min(max(y + d_y, area.top - 40), area.bottom + 40)
+            script.append(("motion", pygame.event.Event(pygame.MOUSEMOTION, pos = (x, y), rel = (d_x, d_y),
+                                                         buttons = (0, 0, 0))))
+    return script
+
+
+def bench_level(game, i, events, seed = 0):
+    '''
+    Feed a level "events" scripted events, starting it over whenever it's
+    won or lost. Returns {operation: summary()}.
+    '''
+    import alchemy
+    kinds = ("motion", "rotate", "place")
+    times = {}
+    for operation in kinds + LEVEL_METHODS + ENGINE_METHODS:
+        times[operation] = []
+    game.events = ScriptedEvents(event_script(alchemy.GRID_AREA, events, seed), times)
+    random.seed(seed)
+    while not game.events.done():
+        game.events.restart()
+        level = alchemy.Level(game, "level_%i" % i)
+        for name in LEVEL_METHODS:
+            setattr(level, name, timed(getattr(level, name), times[name]))
+        for name in ENGINE_METHODS:
+            setattr(level.engine, name, timed(getattr(level.engine, name), times[name]))
+        level.run()
+        level.close()
+    result = {}
+    for operation, op_times in times.items():
+        result[operation] = summary(op_times)
+    return result
+
+
+def levels(numbers, events, seed = 0):
+    '''Run the levels benchmark in a game window. Returns the results as saved in JSON.'''
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    import pygame
+    import alchemy
+
+    game = alchemy.Game()
+    game.username = "benchmark"
+    game.score = 0
+    # Everything is researched already, so no level saves a profile
+    game.user = game.saves.load("progress_init")
+    for i in numbers:
+        research = game.levels.load("level_%i" % i).get("research")
+        if research and research not in game.user["substances"]:
+            game.user["substances"].append(research)
+
+    results = {
+        "meta": {
+            "events": events,
+            "seed": seed,
+            "time": time.time(),
+            "python": platform.python_version(),
+            "pygame": pygame.version.ver,
+            "video_driver": pygame.display.get_driver(),
+            },
+        "levels": {},
+        }
+    for i in numbers:
+        results["levels"]["level_%i" % i] = bench_level(game, i, events, seed + i)
+    return results
+
+
+def print_levels(results, compare = None):
+    '''
+    Print the results of the levels benchmark. With the results of an
+    earlier run, show how the medians changed and return the operations
+    that got slower than REGRESSION allows.
+    '''
+    columns = ("count", "p50", "p90", "p99", "max", "ops_per_sec")
+    slower = []
+    for level_id in sorted(results["levels"]):
+        print level_id
+        print "    %-20s " % "operation" + " ".join(["%11s" % column for column in columns]) + \
+            (" %9s" % "vs p50" if compare else "")
+        for operation, stats in sorted(results["levels"][level_id].items()):
+            if not stats["count"]: continue
+            line = "    %-20s %11i " % (operation, stats["count"])
+            line += " ".join(["%8.1f us" % (stats[column] * 1e6) for column in columns[1:-1]])
+            line += " %11.0f" % stats["ops_per_sec"]
+            old = compare and compare["levels"].get(level_id, {}).get(operation)
+            if old and old["p50"]:
+                change = stats["p50"] / old["p50"] - 1
+                line += " %+8.0f%%" % (change * 100)
+                if change > REGRESSION and stats["count"] >= REGRESSION_COUNT:
+                    line += " slower"
+                    slower.append((level_id, operation))
+            print line
+    return slower
+
+
+def main(args = None):
+    parser = optparse.OptionParser(usage = "%prog boards [options] [ROWSxCOLS ...]\n"
+                                           "       %prog levels [options] [LEVEL ...]")
+    parser.add_option("-n", "--placements", "--events", type = "int", default = None,
+                      help = "placements per board size [500] or events per level [2000]")
+    parser.add_option("-s", "--seed", type = "int", default = 0,
+                      help = "seed of the scripted events [%default]")
+    parser.add_option("-o", "--output", metavar = "FILE",
+                      help = "save the results of the levels benchmark as JSON")
+    parser.add_option("-c", "--compare", metavar = "FILE",
+                      help = "compare the levels benchmark with results saved earlier")
+    options, args = parser.parse_args(args)
+    if not args or args[0] not in ("boards", "levels"):
+        parser.error("which benchmark?")
+
+    if args[0] == "boards":
+        sizes = BOARD_SIZES
+        if args[1:]:
+            try:
+                sizes = [tuple(map(int, size.split("x"))) for size in args[1:]]
+            except ValueError:
+                parser.error("board sizes are given as ROWSxCOLS")
+        boards(sizes, options.placements or 500)
+        return
+
+    numbers = LEVELS
+    if args[1:]:
+        try:
+            numbers = map(int, args[1:])
+        except ValueError:
+            parser.error("levels are given by their numbers")
+    compare = None
+    if options.compare:
+        compare_file = open(options.compare, "rb")
+        compare = json.loads(compare_file.read())
+        compare_file.close()
+    results = levels(numbers, options.placements or 2000, options.seed)
+    slower = print_levels(results, compare)
+    if options.output:
+        output_file = open(options.output, "wb")
+        output_file.write(json.dumps(results, indent = 1, sort_keys = True))
+        output_file.close()
+    if slower:
+        sys.exit("%i operations got slower" % len(slower))
+
+if __name__ == '__main__':
+    main()
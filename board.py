@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+#
+#       Bitboard representation of the Alchemy game field.
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+The game field as a set of integer bitmasks.
+
+Cell (row, col) is bit number row * cols + col. Every cell value ("0", "1s",
+"b", "3l", ...) sets one bit in the mask of its first character (the element,
+or "0" for free cells, "b" for borders, "o" for old metal) and possibly one
+bit in the "spoilt" or "locked" state mask. Checking whether a figure fits
+is then a few shifts and ANDs instead of comparing strings cell by cell.
+
+On top of that PlacementIndex remembers where every figure shape seen so far
+can be placed and only rechecks the anchors around cells that became free
+or taken, so asking whether a figure fits anywhere costs next to nothing.
+
+If NumPy is installed the board also keeps an int8 copy of the field with
+the match code of every cell (see match_code()), for matches.py.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FREE = "0"
+BORDER = "b"
+OLD = "o"
+SPOILT = "s"
+LOCKED = "l"
+
+# Biggest number of rows and columns a board may have
+MAX_SIZE = 200
+
+# Masks are turned back into cells CHUNK bits at a time, see Board.cells()
+CHUNK = 64
+CHUNK_MASK = (1 << CHUNK) - 1
+CHUNK_BITS = dict([(1 << i, i) for i in range(CHUNK)])
+
+
+def match_code(value):
+    '''
+    Small integer telling which cells make a match with each other: the
+    element for elements (spoilt or not), 0 for everything else and for
+    locked cells, which never match
+    '''
+    if value[0].isdigit() and value[0] != FREE and not (len(value) > 1 and value[-1] == LOCKED):
+        return int(value[0])
+    return 0
+
+
+def level_field(level):
+    '''
+    The field of a level dict. Levels may give their "width" and "height";
+    a level without a "field" starts with an empty field of that size.
+    '''
+    if "field" not in level:
+        return [[FREE] * level["width"] for row in range(level["height"])]
+    field = level["field"]
+    height = len(field)
+    width = len(field[0]) if field else 0
+    if level.get("width", width) != width or level.get("height", height) != height:
+        raise ValueError("The field is %ix%i, not %sx%s" % (width, height, level.get("width"), level.get("height")))
+    return field
+
+
+class Board(object):
+    def __init__(self, field):
+        '''Build the board from a "field" list as found in the level files'''
+        # String values are still kept around: they are what the renderer
+        # draws. They must only be changed through self.set().
+        self.grid = [[str(cell) for cell in row] for row in field]
+        self.rows = len(self.grid)
+        self.cols = len(self.grid[0]) if self.grid else 0
+        if self.rows > MAX_SIZE or self.cols > MAX_SIZE:
+            raise ValueError("A board can't be bigger than %ix%i" % (MAX_SIZE, MAX_SIZE))
+        for row in self.grid:
+            if len(row) != self.cols:
+                raise ValueError("All rows of a board must have the same length")
+
+        # masks[first character] -> bitmask of cells starting with it
+        self.masks = {}
+        self.spoilt = 0
+        self.locked = 0
+        for rnum, row in enumerate(self.grid):
+            for cnum, cell in enumerate(row):
+                self._add(self.bit(rnum, cnum), cell)
+
+        # codes[row, col] is match_code() of the cell
+        self.codes = None
+        if numpy is not None:
+            self.codes = numpy.array([[match_code(cell) for cell in row] for row in self.grid],
+                                     numpy.int8).reshape(self.rows, self.cols)
+
+        # Anchors a figure of given height and width may have, see anchors()
+        self._anchor_cache = {}
+        self.index = PlacementIndex(self)
+        # Cells changed since the last call to take_changes()
+        self.changed = set()
+        # While it's a list, every change is added to it as (row, col, old value), see history.py
+        self.journal = None
+
+    def bit(self, row, col):
+        '''The bit of cell (row, col)'''
+        return 1 << (row * self.cols + col)
+
+    def _add(self, bit, value):
+        self.masks[value[0]] = self.masks.get(value[0], 0) | bit
+        if value[-1] == SPOILT and len(value) > 1: self.spoilt |= bit
+        if value[-1] == LOCKED and len(value) > 1: self.locked |= bit
+
+    def _remove(self, bit, value):
+        self.masks[value[0]] &= ~bit
+        self.spoilt &= ~bit
+        self.locked &= ~bit
+
+    @property
+    def free(self):
+        return self.masks.get(FREE, 0)
+
+    @property
+    def border(self):
+        return self.masks.get(BORDER, 0)
+
+    @property
+    def old(self):
+        return self.masks.get(OLD, 0)
+
+    def get(self, row, col):
+        return self.grid[row][col]
+
+    def set(self, row, col, value):
+        '''Change the value of a cell keeping the masks in sync'''
+        bit = self.bit(row, col)
+        if self.journal is not None: self.journal.append((row, col, self.grid[row][col]))
+        was_free = self.grid[row][col] == FREE
+        self._remove(bit, self.grid[row][col])
+        self.grid[row][col] = value
+        self._add(bit, value)
+        if self.codes is not None: self.codes[row, col] = match_code(value)
+        self.changed.add((row, col))
+        if was_free != (value == FREE):
+            self.index.cell_changed(row, col)
+
+    def cells(self, mask):
+        '''List of (row, col) of the cells set in a mask'''
+        cells = []
+        base = 0
+        while mask:
+            chunk = mask & CHUNK_MASK
+            while chunk:
+                low = chunk & -chunk
+                number = base + CHUNK_BITS[low]
+                cells.append((number // self.cols, number % self.cols))
+                chunk ^= low
+            mask >>= CHUNK
+            base += CHUNK
+        return cells
+
+    def take_changes(self):
+        '''Return the set of cells changed since the last call and forget them'''
+        changed, self.changed = self.changed, set()
+        return changed
+
+    def inside(self, row, col):
+        return 0 <= row < self.rows and 0 <= col < self.cols
+
+    def is_free(self, row, col):
+        '''Whether (row, col) is inside the board and empty'''
+        return self.inside(row, col) and bool(self.free & self.bit(row, col))
+
+    def matching(self, value):
+        '''
+        Bitmask of cells a cell with given value makes a match with: the same
+        element (spoilt or not, we compare only the first character) and not locked
+        '''
+        return self.masks.get(value[0], 0) & ~self.locked
+
+    def figure_shape(self, figure):
+        '''
+        Return (offsets, height, width) of a figure: offsets are bit
+        numbers of its non-empty cells relative to its top left corner.
+        Empty cells don't count, so height and width are those of the
+        non-empty part.
+        '''
+        offsets = []
+        height = width = 0
+        for rnum, c_row in enumerate(figure):
+            for cnum, cell in enumerate(c_row):
+                if not cell: continue
+                offsets.append(rnum * self.cols + cnum)
+                height = max(height, rnum + 1)
+                width = max(width, cnum + 1)
+        return offsets, height, width
+
+    def fits(self, figure, row, col):
+        '''Whether the whole figure fits with its top left corner at (row, col)'''
+        offsets, height, width = self.figure_shape(figure)
+        return self.fits_shape(offsets, height, width, row, col)
+
+    def fits_shape(self, offsets, height, width, row, col):
+        '''Same as fits(), for a shape already returned by figure_shape()'''
+        if row < 0 or col < 0 or row + height > self.rows or col + width > self.cols:
+            return False
+        mask = 0
+        for offset in offsets:
+            mask |= 1 << offset
+        shifted = mask << (row * self.cols + col)
+        return shifted & self.free == shifted
+
+    def anchors(self, height, width):
+        '''Bitmask of top left corners where a height x width box stays inside the board'''
+        key = height, width
+        if key not in self._anchor_cache:
+            mask = 0
+            if width <= self.cols:
+                row_mask = (1 << (self.cols - width + 1)) - 1
+                for row in range(self.rows - height + 1):
+                    mask |= row_mask << (row * self.cols)
+            self._anchor_cache[key] = mask
+        return self._anchor_cache[key]
+
+    def placements(self, figure):
+        '''Bitmask of all top left corners where the figure fits'''
+        return self.index.placements(figure)
+
+    def fits_anywhere(self, figure):
+        '''Whether the figure fits somewhere on the board'''
+        return self.index.fits_anywhere(figure)
+
+    def scan_placements(self, offsets, height, width, free = None):
+        '''
+        Compute placements of a shape from scratch (on the given mask of
+        free cells, the board's one by default).
+        Each figure cell is one shift and AND over the whole board.
+        '''
+        result = self.anchors(height, width)
+        if free is None: free = self.free
+        for offset in offsets:
+            if not result: break
+            result &= free >> offset
+        return result
+
+
+class PlacementIndex(object):
+    '''
+    Anchors (top left corners) where each known figure shape fits, kept as
+    one small bitmask per board row plus their total number.
+    A shape is computed from scratch the first time it's asked about.
+    After that Board.set() only logs the cells that became free or taken,
+    and a shape catches up with the log when it's asked about again. A logged
+    change costs the same on a board of any size, and shapes nobody holds
+    at the moment cost nothing.
+    '''
+    # Shapes that fall further behind the log than this are computed from scratch again
+    MAX_LOG = 1024
+
+    def __init__(self, board):
+        self.board = board
+        # shape key -> [cells, offsets, height, width, anchor rows, number of anchors,
+        #               number of the next change to apply]
+        self.shapes = {}
+        # (row, col) of changed cells, log[0] is change number self.first
+        self.log = []
+        self.first = 0
+
+    @staticmethod
+    def shape_key(figure):
+        '''Coords of the non-empty cells of a figure: figures with equal keys fit in the same places'''
+        cells = []
+        for rnum, c_row in enumerate(figure):
+            for cnum, cell in enumerate(c_row):
+                if cell: cells.append((rnum, cnum))
+        return tuple(cells)
+
+    def entry(self, figure):
+        '''The up to date entry of a figure shape'''
+        key = self.shape_key(figure)
+        entry = self.shapes.get(key)
+        end = self.first + len(self.log)
+        if entry is None or entry[6] < self.first:
+            board = self.board
+            offsets, height, width = board.figure_shape(figure)
+            anchors = board.scan_placements(offsets, height, width)
+            row_mask = (1 << board.cols) - 1
+            rows = [(anchors >> (row * board.cols)) & row_mask for row in range(board.rows)]
+            count = len(board.cells(anchors))
+            entry = self.shapes[key] = [key, offsets, height, width, rows, count, end]
+        elif entry[6] < end:
+            for row, col in self.log[entry[6] - self.first:]:
+                self.update(entry, row, col)
+            entry[6] = end
+        return entry
+
+    def placements(self, figure):
+        '''Bitmask of the anchors of a figure over the whole board'''
+        cols = self.board.cols
+        mask = 0
+        for row, row_anchors in enumerate(self.entry(figure)[4]):
+            if row_anchors: mask |= row_anchors << (row * cols)
+        return mask
+
+    def fits_anywhere(self, figure):
+        return self.entry(figure)[5] > 0
+
+    def cell_changed(self, row, col):
+        '''A cell became free or taken'''
+        self.log.append((row, col))
+        if len(self.log) > self.MAX_LOG:
+            drop = len(self.log) // 2
+            del self.log[:drop]
+            self.first += drop
+
+    def update(self, entry, row, col):
+        '''
+        Apply one logged change to a shape. Only anchors from which some
+        figure cell lands on (row, col) may have changed, and they are
+        checked against the grid as it is now.
+        '''
+        board = self.board
+        grid = board.grid
+        cells, offsets, height, width, rows = entry[:5]
+        for rnum, cnum in cells:
+            a_row, a_col = row - rnum, col - cnum
+            if a_row < 0 or a_col < 0 or a_row + height > board.rows or a_col + width > board.cols:
+                continue
+            bit = 1 << a_col
+            fits = True
+            for f_row, f_col in cells:
+                if grid[a_row + f_row][a_col + f_col] != FREE:
+                    fits = False
+                    break
+            if fits and not rows[a_row] & bit:
+                rows[a_row] |= bit
+                entry[5] += 1
+            elif not fits and rows[a_row] & bit:
+                rows[a_row] &= ~bit
+                entry[5] -= 1
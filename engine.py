@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+#
+#       Game rules of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Headless game rules engine.
+
+Everything that decides what happens on the field lives here: figure
+generation, placement, matches and aging of metals. Nothing in this module
+touches pygame, so levels can be played (and simulated) without a display.
+Time and randomness are injected, see Engine.__init__().
+'''
+
+import heapq
+import random
+import time
+
+from board import Board, level_field, FREE, BORDER, OLD
+from figures import table
+from matches import find_matches
+
+ELEMENTS = {
+    "1": "mercury",
+    "2": "saturn",
+    "3": "jupiter",
+    "4": "moon",
+    "5": "venus",
+    "6": "mars",
+    "7": "sun",
+    "1s": "mercury_spoilt",
+    "2s": "saturn_spoilt",
+    "3s": "jupiter_spoilt",
+    "5s": "venus_spoilt",
+    "6s": "mars_spoilt",
+    "o": "old"
+    }
+
+# Moon and Sun are not metals, so they never age
+NOT_AGING = ("4", "7")
+
+# A piece of metal ages in AGE_TIME seconds (plus some random jitter)
+AGE_TIME = 60
+AGE_JITTER = 5
+
+
+class WallClock(object):
+    '''Seconds elapsed since the clock was created, as an integer'''
+    def __init__(self):
+        self.start = time.time()
+
+    def __call__(self):
+        return int(time.time() - self.start)
+
+
+class ManualClock(object):
+    '''A clock that only moves when told to. Used for headless games.'''
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class AgingTimers(object):
+    '''
+    Aging deadlines of the grid cells.
+    Deadlines are kept in a min-heap of (deadline, row, col, generation).
+    Every time the timer of a cell changes its generation is bumped, so
+    heap entries left from older timers are simply skipped when popped.
+    '''
+    def __init__(self, rows, cols):
+        # deadlines[row][col] is 0 if the cell has no timer
+        self.deadlines = [[0] * cols for row in range(rows)]
+        self.generations = [[0] * cols for row in range(rows)]
+        self.heap = []
+        self.size = rows * cols
+        # (row, col, old deadline) of every change while it's a list, like Board.journal
+        self.journal = None
+
+    def set(self, row, col, deadline):
+        '''Set the timer of a cell, 0 clears it'''
+        if self.journal is not None: self.journal.append((row, col, self.deadlines[row][col]))
+        generation = self.generations[row][col] + 1
+        self.generations[row][col] = generation
+        self.deadlines[row][col] = deadline
+        if deadline:
+            heapq.heappush(self.heap, (deadline, row, col, generation))
+            # Too many outdated entries, rebuild the heap from the deadlines
+            if len(self.heap) > 4 * self.size: self.rebuild()
+
+    def clear(self, row, col):
+        self.set(row, col, 0)
+
+    def rebuild(self):
+        self.heap = []
+        for rnum, row in enumerate(self.deadlines):
+            for cnum, deadline in enumerate(row):
+                if deadline:
+                    self.heap.append((deadline, rnum, cnum, self.generations[rnum][cnum]))
+        heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        heap = self.heap
+        while heap and heap[0][3] != self.generations[heap[0][1]][heap[0][2]]:
+            heapq.heappop(heap)
+
+    def next_deadline(self):
+        '''The earliest deadline, or None if no metal is aging'''
+        self._drop_stale()
+        if self.heap: return self.heap[0][0]
+        return None
+
+    def due(self, now):
+        '''Pop the cells whose deadline has come, sorted by row and column'''
+        cells = []
+        heap = self.heap
+        while True:
+            self._drop_stale()
+            if not heap or heap[0][0] > now: break
+            deadline, row, col, generation = heapq.heappop(heap)
+            cells.append((row, col))
+        cells.sort()
+        return cells
+
+
+class Engine(object):
+    def __init__(self, level, score=0, substances=(), costs=None, clock=None, rng=None):
+        '''
+        Initialize the rules for a level.
+        "level" is a dict in the same format as the levels/level_N files.
+        "clock" is a callable returning current time in seconds,
+        "rng" is a random.Random-like object the seeds of the figures and
+        of metal aging are drawn from.
+        '''
+        self.clock = clock or WallClock()
+        # Figures and aging have random streams of their own, both made
+        # from their seed and the number of figures dealt so far: the seed
+        # fixes the sequence of figures however metal ages, and a position
+        # goes on the same way whenever it's come back to
+        rng = rng or random.Random()
+        self.figure_seed = rng.getrandbits(32)
+        self.aging_seed = rng.getrandbits(32)
+        self.dealt = 0
+        self.rng = random.Random()
+        # Everything the player does can be recorded, see replay.Recorder
+        self.recorder = None
+        # Match handling can be timed, see profiler.Profiler
+        self.profiler = None
+
+        self.score = score
+        # Snapshots keep the score earned on the level, see snapshot()
+        self.initial_score = score
+        self.substances = list(substances)
+        self.costs = costs or {}
+        # FIXME: Bonus is going to be one of the main game parameters as well
+        self.bonus = 0
+        self.active_subst = ""
+
+        # Level parameters. self.grid holds the cell values for reading only,
+        # the board has to be used to change them.
+        self.board = Board(level_field(level))
+        self.grid = self.board.grid
+        # The field the level starts with, snapshots only keep what differs from it
+        self.field = [row[:] for row in self.grid]
+        self.rows = self.board.rows
+        self.cols = self.board.cols
+        self.figure_max_size = level["figure_max_size"]
+        self.figure_table = table(self.figure_max_size)
+        self.elements = level["elements"]
+        self.spoilt = level["spoilt"]
+        self.locked = level["locked"]
+        self.goal = dict(level["goal"])
+
+        self.victory = False
+        self.defeat = False
+        # Whether the last placement produced at least one match
+        self.matched = False
+
+        # Figures are shapes from the figure table and all 4 rotations of
+        # them, see get_next_figure()
+        self.shape = self.next_shape = None
+        self.figures = self.next_figures = [[], [], [], []]
+        # How many times the current figure has been rotated (modulo 4)
+        self.rotation = 0
+        self.timers = AgingTimers(self.rows, self.cols)
+        # Same as the board and the grid: read it, change it through self.timers
+        self.timer_grid = self.timers.deadlines
+
+    def start(self, state = None):
+        '''
+        Generate the first two figures and start the metal timers, or
+        carry on from "state", a snapshot() of the same level
+        '''
+        if state is not None:
+            self.resume(state)
+            if self.recorder: self.recorder.start(self.clock())
+            return
+        self.shape, self.figures = self.get_next_figure()
+        self.next_shape, self.next_figures = self.get_next_figure()
+        self.reseed()
+        self.global_check_place()
+
+        now = self.clock()
+        if self.recorder: self.recorder.start(now)
+        for rnum, row in enumerate(self.grid):
+            for cnum, cell in enumerate(row):
+                if cell != FREE and cell != BORDER and cell not in NOT_AGING:
+                    self.timers.set(rnum, cnum, now + AGE_TIME + self.rng.randint(0, AGE_JITTER))
+
+    def snapshot(self):
+        '''
+        The state of the level as a dict that can be saved as JSON and
+        given to start() of a new engine. Only the cells that differ from
+        the level's field are kept, timers as the seconds they have left
+        (so the clock may start from anything) and the score as what was
+        earned on the level. Aging starts its random stream over (see
+        reseed()), so the level goes on the same way from the snapshot.
+        '''
+        now = self.clock()
+        self.reseed()
+        cells = []
+        timers = []
+        for rnum, row in enumerate(self.grid):
+            field_row = self.field[rnum]
+            deadlines = self.timer_grid[rnum]
+            for cnum, cell in enumerate(row):
+                if cell != field_row[cnum]: cells.append([rnum, cnum, cell])
+                if deadlines[cnum]: timers.append([rnum, cnum, deadlines[cnum] - now])
+        return {
+            "cells": cells,
+            "timers": timers,
+            "goal": dict(self.goal),
+            "score": self.score - self.initial_score,
+            "bonus": self.bonus,
+            "active_subst": self.active_subst,
+            "figures": [self.figure_state(self.shape, self.figures),
+                        self.figure_state(self.next_shape, self.next_figures)],
+            "rotation": self.rotation,
+            "figure_seed": self.figure_seed,
+            "aging_seed": self.aging_seed,
+            "dealt": self.dealt,
+            }
+
+    def figure_state(self, shape, figures):
+        '''[number of the shape in the figure table, elements of its cells]'''
+        return [self.figure_table.shapes.index(shape), [figures[0][row][col] for row, col in shape.cells[0]]]
+
+    def resume(self, state):
+        '''Put a snapshot() on the board of an engine that hasn't started yet'''
+        now = self.clock()
+        for rnum, cnum, cell in state["cells"]:
+            self.board.set(rnum, cnum, str(cell))
+        for rnum, cnum, left in state["timers"]:
+            self.timers.set(rnum, cnum, now + left)
+        self.goal = dict(state["goal"])
+        self.score = self.initial_score + state["score"]
+        self.bonus = state["bonus"]
+        self.active_subst = state["active_subst"]
+        figures = []
+        for number, elements in state["figures"]:
+            shape = self.figure_table.shapes[number]
+            elements = [str(element) for element in elements]
+            figures.append((shape, [shape.grid(rotation, elements) for rotation in range(4)]))
+        (self.shape, self.figures), (self.next_shape, self.next_figures) = figures
+        self.rotation = state["rotation"]
+        self.figure_seed = state["figure_seed"]
+        self.aging_seed = state["aging_seed"]
+        self.dealt = state["dealt"]
+        self.reseed()
+        self.global_check_place()
+
+    @property
+    def figure(self):
+        '''The current figure as it is rotated now'''
+        return self.figures[self.rotation]
+
+    @property
+    def next_figure(self):
+        return self.next_figures[0]
+
+    def get_next_figure(self):
+        '''
+        Generate a new figure: pick a shape from the figure table and an
+        element for every cell. Returns the shape and the list of all 4
+        rotations of the figure.
+        This function is called from self.start() to generate 2 initial figures
+        and then from self.place() every time we need a new figure.
+        '''
+        rng = random.Random(self.figure_seed << 32 | self.dealt)
+        self.dealt += 1
+        shape = self.figure_table.choose(rng)
+        elements = []
+        for i in range(shape.size):
+            element = rng.choice(self.elements)
+            if element in self.spoilt:
+                element = rng.choice((element, element+"s"))
+            elements.append(element)
+        return shape, [shape.grid(rotation, elements) for rotation in range(4)]
+
+    def reseed(self):
+        '''Start the random stream of aging over for the number of figures dealt'''
+        self.rng.seed(self.aging_seed << 32 | self.dealt)
+
+    def rotate(self):
+        '''Rotate the current figure clockwise'''
+        self.rotation = (self.rotation + 1) % 4
+
+    def check_place(self, row, col, figure=None):
+        '''
+        Return a dict {(rnum, cnum): fits} for every non-empty cell of the figure
+        placed with its top left corner at (row, col).
+        '''
+        if figure is None: figure = self.figure
+        results = {}
+        for rnum, c_row in enumerate(figure):
+            for cnum, cell in enumerate(c_row):
+                if not cell: continue       # No need to check an empty cell
+                results[rnum, cnum] = self.board.is_free(row + rnum, col + cnum)
+        return results
+
+    def can_place(self, row, col, figure=None):
+        '''Whether the whole figure fits with its top left corner at (row, col)'''
+        if figure is None:
+            offsets, height, width = self.shape.layout(self.rotation, self.cols)
+            return self.board.fits_shape(offsets, height, width, row, col)
+        return self.board.fits(figure, row, col)
+
+    def global_check_place(self):
+        '''
+        Check if there is enough free space on the grid for current figure.
+        If not, user lost this game.
+        '''
+        # We look for a place for any rotation of the figure
+        for figure in self.figures:
+            if self.board.fits_anywhere(figure):
+                return True
+
+        # No place was found for current figure => the game is lost
+        self.defeat = True
+        return False
+
+    def place(self, row, col):
+        '''
+        Put the current figure on the grid with its top left corner at (row, col),
+        handle matches for the new values and take the next figure.
+        Returns False (and changes nothing) if the figure does not fit there.
+        '''
+        if self.defeat or self.victory or not self.can_place(row, col):
+            return False
+
+        now = self.clock()
+        if self.recorder: self.recorder.place(now, row, col, self.rotation)
+
+        # Update grid values
+        placed = []
+        for rnum, c_row in enumerate(self.figure):
+            for cnum, cell in enumerate(c_row):
+                if cell:
+                    self.board.set(row + rnum, col + cnum, cell)
+                    if cell not in NOT_AGING:
+                        self.timers.set(row + rnum, col + cnum, now + AGE_TIME)
+                    placed.append(((row + rnum, col + cnum), cell))
+
+        # Find and destroy matches for every cell of the figure
+        if self.profiler: self.profiler.begin("matches")
+        self.matched = self.handle_matches(placed)
+        if self.profiler: self.profiler.end()
+
+        # Take the next figure and check if it can be placed anywhere
+        self.shape, self.figures = self.next_shape, self.next_figures
+        self.rotation = 0
+        self.next_shape, self.next_figures = self.get_next_figure()
+        self.reseed()
+        if not self.victory:
+            self.global_check_place()
+        return True
+
+    def use_substance(self, subst):
+        '''
+        Activate a researched substance if there is enough bonus for it.
+        Returns True if the substance was activated.
+        '''
+        if subst not in self.substances or self.active_subst:
+            return False
+        if self.bonus < self.costs[subst]:
+            return False
+        self.active_subst = subst
+        self.bonus -= self.costs[subst]
+        if self.recorder: self.recorder.substance(self.clock(), self.substances.index(subst))
+        return True
+
+    def next_deadline(self):
+        '''Time when some metal ages next, or None. Nothing changes on the grid before that.'''
+        return self.timers.next_deadline()
+
+    def tick(self):
+        '''
+        Check if one or more pieces of metal aged.
+        Returns True if the grid has changed.
+        '''
+        now = self.clock()
+        due = self.timers.due(now)
+        if due and self.recorder: self.recorder.age(now)
+        for rnum, cnum in due:
+            value = self.grid[rnum][cnum]
+            if value[-1] != "s" and value != OLD and value != BORDER:
+                self.board.set(rnum, cnum, value + "s")
+                self.timers.set(rnum, cnum, now + AGE_TIME + self.rng.randint(0, AGE_JITTER))
+            else:
+                self.board.set(rnum, cnum, OLD)
+                self.timers.clear(rnum, cnum)
+        return bool(due)
+
+    def handle_matches(self, placed):
+        '''
+        Find all matches made by the placed cells (a list of ((row, col), value))
+        and destroy all matching cells, see matches.find_matches().
+        Returns True if there was a match.
+        '''
+        cleared, score, bonus, goal = find_matches(self.board, placed)
+        if not cleared: return False
+
+        for element, lines in goal.items():
+            if element in self.goal:
+                self.goal[element] = max(0, self.goal[element] - lines)
+        for d_row, d_col in sorted(cleared):
+            self.board.set(d_row, d_col, FREE)
+            self.timers.clear(d_row, d_col)
+        self.score += score
+        self.bonus += bonus
+        if all([quantity == 0 for quantity in self.goal.values()]): self.victory = True
+        return True
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+#       Figure shapes of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Precomputed table of figure shapes.
+
+Figures are polyominoes: cells connected by their sides. The table holds
+every polyomino up to the given size that can't be turned into another one
+by rotation (so both "L" and its mirror image "J" are there, since the
+player can rotate a figure but not flip it), together with its 4 rotations.
+Generating a figure is then one weighted lookup in the table.
+'''
+
+import bisect
+
+
+def normalize(cells):
+    '''Move cells to the top left corner and sort them row by row'''
+    top = min([row for row, col in cells])
+    left = min([col for row, col in cells])
+    return tuple(sorted([(row - top, col - left) for row, col in cells]))
+
+
+def rotate_cells(cells):
+    '''
+    Rotate normalized cells clockwise, the same way the figure grids are
+    rotated (zip(*figure[::-1])). The cells stay in the same order, so the
+    i-th of them is the same cell of the figure before and after.
+    '''
+    height = max([row for row, col in cells]) + 1
+    return tuple([(col, height - 1 - row) for row, col in cells])
+
+
+class Polyomino(object):
+    def __init__(self, cells):
+        # Cells of every rotation in the order of the first one: the i-th
+        # cell of each is where the i-th element goes, see grid()
+        self.cells = [normalize(cells)]
+        for i in range(3):
+            self.cells.append(rotate_cells(self.cells[i]))
+        self.rotations = [tuple(sorted(cells)) for cells in self.cells]
+        # The same for all rotations of the shape
+        self.canonical = min(self.rotations)
+        self.size = len(cells)
+        self.heights = [max([row for row, col in cells]) + 1 for cells in self.rotations]
+        self.widths = [max([col for row, col in cells]) + 1 for cells in self.rotations]
+        # cols -> [(offsets, height, width) for every rotation], see layout()
+        self._layouts = {}
+
+    def layout(self, rotation, cols):
+        '''
+        (offsets, height, width) of a rotation on a board with given number
+        of columns, in the format of Board.figure_shape()
+        '''
+        if cols not in self._layouts:
+            layouts = []
+            for r, cells in enumerate(self.rotations):
+                offsets = [row * cols + col for row, col in cells]
+                layouts.append((offsets, self.heights[r], self.widths[r]))
+            self._layouts[cols] = layouts
+        return self._layouts[cols][rotation]
+
+    def grid(self, rotation, elements):
+        '''
+        Figure in the usual list of lists format, "elements" are values
+        of cells in the order of the first rotation
+        '''
+        grid = [["" for col in range(self.widths[rotation])] for row in range(self.heights[rotation])]
+        for (row, col), element in zip(self.cells[rotation], elements):
+            grid[row][col] = element
+        return grid
+
+
+def polyominoes(max_size):
+    '''All polyominoes of 1 to max_size cells, different up to rotation'''
+    shapes = []
+    level = [normalize([(0, 0)])]
+    for size in range(1, max_size + 1):
+        seen = {}
+        for cells in level:
+            shape = Polyomino(cells)
+            if shape.canonical not in seen:
+                seen[shape.canonical] = shape
+        shapes.extend(sorted(seen.values(), key = lambda shape: shape.canonical))
+        # Grow every shape of this size by one cell
+        grown = {}
+        for cells in level:
+            taken = set(cells)
+            for row, col in cells:
+                for n_row, n_col in ((row-1, col), (row+1, col), (row, col-1), (row, col+1)):
+                    if (n_row, n_col) not in taken:
+                        grown[normalize(cells + ((n_row, n_col),))] = True
+        level = sorted(grown.keys())
+    return shapes
+
+
+class FigureTable(object):
+    '''
+    Polyominoes up to max_size cells with weights such that every size
+    is equally likely (as it has always been in the game).
+    '''
+    def __init__(self, max_size):
+        self.shapes = polyominoes(max_size)
+        per_size = {}
+        for shape in self.shapes:
+            per_size[shape.size] = per_size.get(shape.size, 0) + 1
+        self.cumulative = []
+        total = 0.0
+        for shape in self.shapes:
+            total += 1.0 / per_size[shape.size]
+            self.cumulative.append(total)
+        self.total = total
+
+    def choose(self, rng):
+        '''A random shape'''
+        index = bisect.bisect_right(self.cumulative, rng.random() * self.total)
+        return self.shapes[min(index, len(self.shapes) - 1)]
+
+
+_tables = {}
+
+def table(max_size):
+    '''The figure table for figures up to max_size cells, built once'''
+    if max_size not in _tables:
+        _tables[max_size] = FigureTable(max_size)
+    return _tables[max_size]
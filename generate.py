@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#
+#       Level generator for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Make new levels and keep the ones that are as hard as wanted.
+
+    python generate.py 20 --like 1 --band 0.3:0.7
+    python alchemy.py generate 20 ...
+
+A candidate level takes everything but the field from a shipped level
+(--like): elements, goal, figure size and so on. Its field is random, with
+the given share of elements, borders and old metal, and symmetric like a
+template (see SYMMETRIES): one cell is rolled and all its mirror images get
+the same value. Fields with 3 or more equal elements in a line are rolled
+again, so the level doesn't start with ready matches.
+
+Every candidate is played by the simulator (see simulate.py) many times
+with different seeds, the games of several candidates spread over one
+process pool. Candidates that are won by the simulator's policy in a share
+of games inside the band are written to the output directory as level
+files, with the numbers they were picked by under "generator".
+'''
+
+import json
+import multiprocessing
+import optparse
+import os
+import random
+import time
+
+from board import BORDER, FREE, OLD
+from replay import load_level
+from simulate import POLICIES, play_game
+
+# Symmetry templates: a field is the same when flipped ...
+SYMMETRIES = {
+    "none": (),
+    # ... left to right
+    "mirror": ("horizontal",),
+    # ... top to bottom
+    "flip": ("vertical",),
+    # ... both ways
+    "quad": ("horizontal", "vertical"),
+    # ... or turned by 180 degrees
+    "rotate": ("turn",),
+    }
+
+# Rerolls of a field with ready matches before it's taken anyway
+REROLLS = 100
+
+
+def mirror_images(row, col, rows, cols, symmetry):
+    '''Cells that must have the same value as (row, col) in a symmetric field'''
+    cells = set([(row, col)])
+    for operation in SYMMETRIES[symmetry]:
+        for c_row, c_col in list(cells):
+            if operation == "horizontal": cells.add((c_row, cols - 1 - c_col))
+            elif operation == "vertical": cells.add((rows - 1 - c_row, c_col))
+            elif operation == "turn": cells.add((rows - 1 - c_row, cols - 1 - c_col))
+    return cells
+
+
+def has_lines(field, length = 3):
+    '''Whether the field has "length" or more equal elements in a row or a column'''
+    rows, cols = len(field), len(field[0])
+    for d_row, d_col in ((0, 1), (1, 0)):
+        for row in range(rows):
+            for col in range(cols):
+                cell = field[row][col]
+                if cell in (FREE, BORDER, OLD): continue
+                end_row, end_col = row + (length - 1) * d_row, col + (length - 1) * d_col
+                if end_row >= rows or end_col >= cols: continue
+                if all([field[row + i * d_row][col + i * d_col] == cell for i in range(1, length)]):
+                    return True
+    return False
+
+
+def random_field(rng, rows, cols, elements, symmetry = "mirror", density = 0.25, walls = 0.1, old = 0.0):
+    '''
+    A rows x cols field, symmetric as "symmetry" says, where about "density"
+    of the cells are elements, "walls" are borders and "old" is old metal
+    '''
+    for attempt in range(REROLLS):
+        field = [[None] * cols for row in range(rows)]
+        for row in range(rows):
+            for col in range(cols):
+                if field[row][col] is not None: continue
+                roll = rng.random()
+                if roll < walls: value = BORDER
+                elif roll < walls + old: value = OLD
+                elif roll < walls + old + density: value = rng.choice(elements)
+                else: value = FREE
+                for c_row, c_col in mirror_images(row, col, rows, cols, symmetry):
+                    field[c_row][c_col] = value
+        if not has_lines(field): break
+    return field
+
+
+def candidate(base, seed, symmetry, density, walls, old):
+    '''A level like "base" with a new random field'''
+    rng = random.Random("level %i" % seed)
+    level = dict(base)
+    rows, cols = len(base["field"]), len(base["field"][0])
+    elements = [element for element in base["elements"] if element not in base["locked"]]
+    level["field"] = random_field(rng, rows, cols, elements, symmetry, density, walls, old)
+    level["research"] = ""
+    level["generator"] = {
+        "seed": seed,
+        "symmetry": symmetry,
+        "density": density,
+        "walls": walls,
+        "old": old,
+        }
+    return level
+
+
+def _play(args):
+    number, level, seed, policy, max_moves, think = args
+    return number, play_game(level, seed, policy, max_moves, think)["won"]
+
+
+def win_rates(levels, games, policy = "greedy", processes = None, max_moves = 1000, think = 3):
+    '''Share of "games" games won by the policy on each of the levels, all of them played in one pool'''
+    tasks = []
+    for number, level in enumerate(levels):
+        for seed in range(games):
+            tasks.append((number, level, seed, policy, max_moves, think))
+    if processes == 1:
+        results = map(_play, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        chunksize = max(1, len(tasks) // (8 * (processes or multiprocessing.cpu_count())))
+        results = list(pool.imap_unordered(_play, tasks, chunksize))
+        pool.close()
+        pool.join()
+    won = [0] * len(levels)
+    for number, victory in results:
+        if victory: won[number] += 1
+    return [float(count) / games for count in won]
+
+
+def generate(base, count, band, games, options):
+    '''
+    Make candidates in batches of "options.batch" until "count" of them
+    have a win rate within "band" (or options.candidates were tried).
+    Returns the levels picked.
+    '''
+    low, high = band
+    picked = []
+    tried = 0
+    seed = options.seed
+    while len(picked) < count and tried < options.candidates:
+        batch = []
+        for i in range(min(options.batch, options.candidates - tried)):
+            batch.append(candidate(base, seed, options.symmetry, options.density, options.walls, options.old))
+            seed += 1
+        tried += len(batch)
+        start = time.time()
+        rates = win_rates(batch, games, options.policy, options.processes, options.moves, options.think)
+        for level, rate in zip(batch, rates):
+            if low <= rate <= high and len(picked) < count:
+                level["generator"]["win_rate"] = rate
+                level["generator"]["games"] = games
+                level["generator"]["policy"] = options.policy
+                picked.append(level)
+        print "%i candidates tried in %.1f s, win rates %s, %i of %i levels picked" % (
+            tried, time.time() - start, " ".join(["%.2f" % rate for rate in rates]), len(picked), count)
+    return picked
+
+
+def save_levels(levels, directory, prefix):
+    if not os.path.isdir(directory): os.makedirs(directory)
+    names = []
+    for number, level in enumerate(levels):
+        level_id = "%s_%i" % (prefix, number + 1)
+        level["name"] = level_id
+        level_file = open(os.path.join(directory, level_id), "w")
+        level_file.write(json.dumps(level, indent = 1, sort_keys = True))
+        level_file.close()
+        names.append(level_id)
+    return names
+
+
+def main(args = None):
+    parser = optparse.OptionParser(usage = "%prog [options] COUNT")
+    parser.add_option("--like", default = "1", metavar = "LEVEL",
+                      help = "level to take everything but the field from [%default]")
+    parser.add_option("--symmetry", choices = sorted(SYMMETRIES.keys()), default = "mirror",
+                      help = "symmetry of the field: %s [%%default]" % ", ".join(sorted(SYMMETRIES.keys())))
+    parser.add_option("--density", type = "float", default = 0.25, help = "share of element cells [%default]")
+    parser.add_option("--walls", type = "float", default = 0.1, help = "share of border cells [%default]")
+    parser.add_option("--old", type = "float", default = 0.0, help = "share of old metal cells [%default]")
+    parser.add_option("--band", default = "0.3:0.7", metavar = "LOW:HIGH",
+                      help = "win rates of the levels to keep [%default]")
+    parser.add_option("-n", "--games", type = "int", default = 40, help = "games per candidate [%default]")
+    parser.add_option("-p", "--policy", choices = sorted(POLICIES.keys()), default = "greedy",
+                      help = "placement policy: %s [%%default]" % ", ".join(sorted(POLICIES.keys())))
+    parser.add_option("-s", "--seed", type = "int", default = 0, help = "seed of the first candidate [%default]")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes [number of CPUs]")
+    parser.add_option("--batch", type = "int", default = 8, help = "candidates played at once [%default]")
+    parser.add_option("--candidates", type = "int", default = 1000,
+                      help = "give up after trying this many candidates [%default]")
+    parser.add_option("--moves", type = "int", default = 1000, help = "give up a game after this many moves [%default]")
+    parser.add_option("--think", type = "int", default = 3, help = "seconds every move takes [%default]")
+    parser.add_option("-o", "--output", default = "levels", metavar = "DIR",
+                      help = "directory for the levels [%default]")
+    parser.add_option("--prefix", default = time.strftime("daily_%Y%m%d"), help = "level file names [%default]")
+    options, args = parser.parse_args(args)
+    if len(args) != 1 or not args[0].isdigit():
+        parser.error("how many levels?")
+    try:
+        band = tuple(map(float, options.band.split(":")))
+        if len(band) != 2: raise ValueError
+    except ValueError:
+        parser.error("the band is given as LOW:HIGH")
+
+    base_id = options.like
+    if base_id.isdigit(): base_id = "level_%s" % base_id
+    levels = generate(load_level(base_id), int(args[0]), band, options.games, options)
+    for name in save_levels(levels, options.output, options.prefix):
+        print os.path.join(options.output, name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+#       High scores of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Leaderboards: every level has one, and the "global" board holds the won
+runs of all the levels together.
+
+Runs are kept in a sqlite table indexed by score, so the top of a board is
+read straight from the index. The rank of a score is counted by a Fenwick
+tree (binary indexed tree) over all possible scores, stored sparsely in
+the same database: adding a run and asking the rank of a score both touch
+SCORE_BITS + 1 tree nodes, however many runs a board has.
+'''
+
+import sqlite3
+import time
+
+SCHEMA_VERSION = 1
+
+# Scores are 0 .. MAX_SCORE, bigger ones count as MAX_SCORE
+SCORE_BITS = 31
+MAX_SCORE = (1 << SCORE_BITS) - 1
+
+GLOBAL = "global"
+
+SCHEMA = """
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY,
+    board TEXT NOT NULL,
+    player TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    played REAL NOT NULL
+);
+CREATE INDEX runs_by_score ON runs (board, score DESC, id);
+
+CREATE TABLE rank_tree (
+    board TEXT NOT NULL,
+    node INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (board, node)
+);
+"""
+
+
+def level_board(level):
+    '''Name of the board of level number "level"'''
+    return "level_%i" % level
+
+
+def tree_index(score):
+    '''
+    Position of a score in the rank tree. Higher scores come first, so a
+    prefix of the tree counts the scores above some score.
+    '''
+    return MAX_SCORE - min(max(score, 0), MAX_SCORE) + 1
+
+
+def update_nodes(index):
+    '''The tree nodes holding the counts of position "index"'''
+    nodes = []
+    while index <= MAX_SCORE + 1:
+        nodes.append(index)
+        index += index & -index
+    return nodes
+
+
+def prefix_nodes(index):
+    '''The tree nodes adding up to the count of positions 1 .. index'''
+    nodes = []
+    while index > 0:
+        nodes.append(index)
+        index -= index & -index
+    return nodes
+
+
+class HighScores(object):
+    def __init__(self, path = "highscores.db"):
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError("%s was made by a newer version of the game" % path)
+        if version == 0:
+            self.db.executescript(SCHEMA)
+            self.db.execute("PRAGMA user_version = %i" % SCHEMA_VERSION)
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def count(self, board, nodes):
+        '''Sum of the counts of the given tree nodes'''
+        marks = ", ".join(["?"] * len(nodes))
+        total = self.db.execute("SELECT SUM(count) FROM rank_tree WHERE board = ? AND node IN (%s)" % marks,
+                                [board] + nodes).fetchone()[0]
+        return total or 0
+
+    def add(self, board, player, score):
+        '''Record a run and return its rank on the board'''
+        db = self.db
+        score = min(max(score, 0), MAX_SCORE)
+        db.execute("INSERT INTO runs (board, player, score, played) VALUES (?, ?, ?, ?)",
+                   (board, player, score, time.time()))
+        nodes = update_nodes(tree_index(score))
+        db.executemany("INSERT OR IGNORE INTO rank_tree (board, node, count) VALUES (?, ?, 0)",
+                       [(board, node) for node in nodes])
+        marks = ", ".join(["?"] * len(nodes))
+        db.execute("UPDATE rank_tree SET count = count + 1 WHERE board = ? AND node IN (%s)" % marks,
+                   [board] + nodes)
+        db.commit()
+        return self.rank(board, score)
+
+    def rank(self, board, score):
+        '''
+        The place a score takes on the board: 1 + the number of better runs,
+        so equal scores share a place
+        '''
+        return self.count(board, prefix_nodes(tree_index(score) - 1)) + 1
+
+    def size(self, board):
+        '''Number of runs on the board'''
+        # The last node of the tree counts everything
+        return self.count(board, [MAX_SCORE + 1])
+
+    def top(self, board, k = 10):
+        '''The best k runs of the board as (player, score), earlier runs first on equal scores'''
+        return self.db.execute("SELECT player, score FROM runs WHERE board = ? ORDER BY score DESC, id LIMIT ?",
+                               (board, k)).fetchall()
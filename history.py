@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+#       Undo and redo of moves in "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Undo and redo of moves, kept as the changes they made.
+
+A move is everything between begin() and commit(). The board and the aging
+timers write the old value of every cell and timer they change to their
+journals (Board.journal, AgingTimers.journal), and a step of the history
+keeps row, col, old, new of the cells and timers that ended up different in
+arrays: a byte each for cells (values are numbered by the history), an int
+each for timers. Metal aging after a move is added to the step of the last
+move not taken back, so undo() puts the board back exactly as it was before
+the move, and redo() takes the cells it changes back from how they are at
+the moment.
+
+The rest of the engine state that a move changes (goal, score, bonus,
+figures, the number of figures dealt) is a tuple shared with the step
+before when it's the same, and the figures in it are references: the
+engine never changes a figure list, only replaces it. So a step costs
+about as much as the cells it changed, and undo() and redo() only touch
+those. The figures still to come are a function of the number dealt (see
+Engine.get_next_figure()), so a move taken back and made again gets the
+same next figure.
+
+Timers are put back with the time they had left, the time that passed
+since doesn't count.
+'''
+
+import array
+import collections
+
+# Moves that can be undone
+UNDO_LIMIT = 500
+
+
+def changes(journal, grid, earlier = ()):
+    '''
+    The cells a journal has changed, on top of the "earlier" changes, as a
+    flat list: row, col, old, new, row, col, ... sorted by row and column
+    '''
+    old = {}
+    for i in range(0, len(earlier), 4):
+        old[earlier[i], earlier[i + 1]] = earlier[i + 2]
+    for row, col, value in journal:
+        if (row, col) not in old: old[row, col] = value
+    flat = []
+    for (row, col), value in sorted(old.items()):
+        if value != grid[row][col]: flat.extend((row, col, value, grid[row][col]))
+    return flat
+
+
+class History(object):
+    def __init__(self, engine, limit = UNDO_LIMIT):
+        self.engine = engine
+        # Steps of the moves: (state before, state after, cells, timers,
+        # time of the move, time of the last change of the step)
+        self.undo_steps = collections.deque(maxlen = limit)
+        self.redo_steps = []
+        self.move = None
+        # Cell values by their numbers in the steps, and the other way round
+        self.values = []
+        self.numbers = {}
+        self.listen()
+
+    def state(self, like = None):
+        '''
+        What a move changes besides the board and the timers. Parts equal
+        to those of the state "like" are taken from it.
+        '''
+        engine = self.engine
+        goal = tuple(sorted(engine.goal.items()))
+        if like is not None and goal == like[0]: goal = like[0]
+        state = (goal, engine.score, engine.bonus, engine.active_subst,
+                 engine.victory, engine.defeat, engine.matched,
+                 engine.shape, engine.figures, engine.next_shape, engine.next_figures, engine.rotation,
+                 engine.dealt)
+        if state == like: return like
+        return state
+
+    def set_state(self, state):
+        engine = self.engine
+        (goal, engine.score, engine.bonus, engine.active_subst,
+         engine.victory, engine.defeat, engine.matched,
+         engine.shape, engine.figures, engine.next_shape, engine.next_figures, engine.rotation,
+         engine.dealt) = state
+        engine.goal = dict(goal)
+        engine.reseed()
+
+    def last_state(self):
+        if self.undo_steps: return self.undo_steps[-1][1]
+        return None
+
+    def number(self, value):
+        '''The number of a cell value in the steps'''
+        if value not in self.numbers:
+            self.numbers[value] = len(self.values)
+            self.values.append(value)
+        return self.numbers[value]
+
+    def pack(self, cells):
+        '''Flat list of cell changes (see changes()) as kept in a step'''
+        packed = array.array("B")
+        for i in range(0, len(cells), 4):
+            packed.extend((cells[i], cells[i + 1], self.number(cells[i + 2]), self.number(cells[i + 3])))
+        return packed
+
+    def unpack(self, packed):
+        cells = list(packed)
+        for i in range(0, len(cells), 4):
+            cells[i + 2] = self.values[cells[i + 2]]
+            cells[i + 3] = self.values[cells[i + 3]]
+        return cells
+
+    def step(self, before, cells, timers, now, then):
+        after = self.state(before)
+        return (before, after, self.pack(cells), array.array("i", timers), now, then)
+
+    def listen(self):
+        '''Start new journals of the board and the timers'''
+        self.engine.board.journal = []
+        self.engine.timers.journal = []
+
+    def fold(self):
+        '''
+        Add the changes made since the last step to it. Without one they
+        happened before the first move and can't be undone.
+        '''
+        engine = self.engine
+        board_journal, timers_journal = engine.board.journal, engine.timers.journal
+        if self.undo_steps and (board_journal or timers_journal):
+            before, after, cells, timers, now, then = self.undo_steps[-1]
+            self.undo_steps[-1] = self.step(before, changes(board_journal, engine.grid, self.unpack(cells)),
+                                            changes(timers_journal, engine.timer_grid, timers), now, engine.clock())
+        self.listen()
+
+    def begin(self):
+        '''Start recording a move'''
+        self.fold()
+        self.move = (self.state(self.last_state()), self.engine.clock())
+
+    def commit(self):
+        '''
+        Finish the move started by begin(). A move that changed nothing
+        (a figure that didn't fit) isn't kept. Returns True if it's kept.
+        '''
+        engine = self.engine
+        before, now = self.move
+        cells = changes(engine.board.journal, engine.grid)
+        timers = changes(engine.timers.journal, engine.timer_grid)
+        self.move = None
+        self.listen()
+        step = self.step(before, cells, timers, now, engine.clock())
+        if not cells and not timers and step[1] is before: return False
+        self.undo_steps.append(step)
+        del self.redo_steps[:]
+        return True
+
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def undo(self):
+        '''Take back the last move. Returns False if there is none.'''
+        if not self.undo_steps: return False
+        self.fold()
+        step = self.undo_steps.pop()
+        self.apply(step, backwards = True)
+        self.set_state(step[0])
+        self.redo_steps.append(step)
+        if self.engine.recorder: self.engine.recorder.undo(self.engine.clock())
+        return True
+
+    def redo(self):
+        '''Make the last move taken back again. Returns False if there is none.'''
+        if not self.redo_steps: return False
+        self.fold()
+        engine = self.engine
+        before, after, cells, timers, now, then = self.redo_steps.pop()
+        # Metal may have aged since the move was taken back: taking it back
+        # again has to return the cells to how they are now
+        cells, timers = array.array("B", cells), array.array("i", timers)
+        for i in range(0, len(cells), 4):
+            cells[i + 2] = self.number(engine.grid[cells[i]][cells[i + 1]])
+        for i in range(0, len(timers), 4):
+            timers[i + 2] = engine.timer_grid[timers[i]][timers[i + 1]]
+        step = (self.state(self.last_state()), after, cells, timers, engine.clock(), then)
+        self.apply(step, backwards = False)
+        self.set_state(after)
+        self.undo_steps.append(step)
+        if self.engine.recorder: self.engine.recorder.redo(self.engine.clock())
+        return True
+
+    def apply(self, step, backwards):
+        '''Set the cells and the timers of a step to their old values (backwards) or their new ones'''
+        engine = self.engine
+        before, after, cells, timers, now, then = step
+        # Timers get back the time they had left at the move, or when the step last changed
+        shift = engine.clock() - (now if backwards else then)
+        value = 2 if backwards else 3
+        for i in range(0, len(cells), 4):
+            engine.board.set(cells[i], cells[i + 1], self.values[cells[i + value]])
+        for i in range(0, len(timers), 4):
+            deadline = timers[i + value]
+            engine.timers.set(timers[i], timers[i + 1], deadline + shift if deadline else 0)
+        self.listen()
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+#       Compiled levels of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Levels checked once and kept in one binary file.
+
+    python levelcache.py [DIRECTORY]
+
+Every level file of a directory is validated (see validate()) and compiled
+into the pack file CACHE_NAME in the same directory:
+
+    header:  "ALVC", format version, number of levels, length of the symbols
+    symbols: the cell values, comma separated; a cell is stored as its index
+    index:   for every level the length of its id, the mtime, size and SHA-1
+             of its source file, the offset and length of its record; the id
+    records: rows, columns, length of the metadata; the metadata (JSON, all
+             of the level but the field); one byte per cell, row by row
+
+The pack is read through mmap, so loading a level is a slice of the field
+bytes and a small JSON document, whatever the number of levels. A level
+whose file has another mtime or size than the index says is read from the
+source instead, unless its SHA-1 is still the same, and update() compiles
+it into the pack again. The pack is written to a temporary file and renamed,
+so a game reading it never sees half of it.
+'''
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+from board import level_field, BORDER, FREE, MAX_SIZE, OLD, SPOILT
+from engine import ELEMENTS
+from storage import write_atomic
+
+CACHE_NAME = ".cache"
+
+MAGIC = "ALVC"
+VERSION = 1
+HEADER = struct.Struct("<4sBIH")
+# Length of the level id, source mtime, size and SHA-1, record offset and length
+ENTRY = struct.Struct("<HdQ20sII")
+# Rows, columns, length of the metadata
+RECORD = struct.Struct("<HHI")
+
+# Cell values a field may hold, in the order of their codes
+SYMBOLS = (FREE, BORDER) + tuple(sorted(ELEMENTS.keys()))
+CODES = dict([(symbol, code) for code, symbol in enumerate(SYMBOLS)])
+
+# Keys every level must have, besides "field" (or "width" and "height")
+REQUIRED = ("elements", "spoilt", "locked", "figure_max_size", "bg_image", "goal")
+
+
+class LevelError(ValueError):
+    '''A level file that isn't a valid level'''
+
+
+def validate(level, level_id = "level"):
+    '''Raise LevelError if a level dict can't be played'''
+    def fail(message, *args):
+        raise LevelError("%s: %s" % (level_id, message % args))
+
+    if not isinstance(level, dict): fail("not a JSON object")
+    for key in REQUIRED:
+        if key not in level: fail("no \"%s\"", key)
+    if "field" not in level and ("width" not in level or "height" not in level):
+        fail("neither a \"field\" nor its \"width\" and \"height\"")
+
+    try:
+        field = level_field(level)
+    except ValueError, error:
+        fail("%s", error)
+    if not field or not field[0]: fail("the field is empty")
+    rows, cols = len(field), len(field[0])
+    if rows > MAX_SIZE or cols > MAX_SIZE: fail("the field is bigger than %ix%i", MAX_SIZE, MAX_SIZE)
+    for rnum, row in enumerate(field):
+        if len(row) != cols: fail("row %i has %i cells, not %i", rnum, len(row), cols)
+        for cnum, cell in enumerate(row):
+            if str(cell) not in CODES: fail("unknown cell \"%s\" at row %i, col %i", cell, rnum, cnum)
+
+    elements = level["elements"]
+    if not elements: fail("no elements")
+    for element in elements:
+        if element not in ELEMENTS or element == OLD or element[-1] == SPOILT:
+            fail("unknown element \"%s\"", element)
+    for element in level["spoilt"]:
+        if element not in elements or element + SPOILT not in ELEMENTS:
+            fail("element \"%s\" can't be spoilt", element)
+    for element in level["locked"]:
+        if element not in elements: fail("locked element \"%s\" isn't one of the elements", element)
+    for element, quantity in level["goal"].items():
+        if element not in elements: fail("goal element \"%s\" isn't one of the elements", element)
+        if not isinstance(quantity, (int, long)) or quantity < 0: fail("goal of \"%s\" is %r", element, quantity)
+    size = level["figure_max_size"]
+    if not isinstance(size, (int, long)) or size < 1: fail("figure_max_size is %r", size)
+
+
+def encode(level):
+    '''The pack record of a valid level'''
+    field = level_field(level)
+    meta = dict(level)
+    meta.pop("field", None)
+    meta = json.dumps(meta, sort_keys = True)
+    codes = "".join([chr(CODES[str(cell)]) for row in field for cell in row])
+    return RECORD.pack(len(field), len(field[0]), len(meta)) + meta + codes
+
+
+def decode(data, offset, symbols):
+    '''The level dict of the record at "offset"'''
+    rows, cols, meta_len = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    level = json.loads(data[offset:offset + meta_len])
+    offset += meta_len
+    cells = map(symbols.__getitem__, bytearray(data[offset:offset + rows * cols]))
+    level["field"] = [cells[start:start + cols] for start in range(0, rows * cols, cols)]
+    return level
+
+
+def compile_level(source, level_id):
+    '''The level dict of a level file's contents, validated'''
+    try:
+        level = json.loads(source)
+    except ValueError, error:
+        raise LevelError("%s: %s" % (level_id, error))
+    validate(level, level_id)
+    return level
+
+
+def read_file(path):
+    source_file = open(path, "rb")
+    source = source_file.read()
+    source_file.close()
+    return source
+
+
+class LevelCache(object):
+    def __init__(self, directory = "levels"):
+        self.directory = directory
+        self.path = os.path.join(directory, CACHE_NAME)
+        # level id -> (mtime, size, SHA-1, offset, length) of the pack
+        self.entries = {}
+        self.symbols = SYMBOLS
+        self.data = None
+        self.open()
+
+    def open(self):
+        '''Map the pack. A missing pack, or one of another version, is just empty.'''
+        self.close()
+        if not os.path.exists(self.path) or not os.path.getsize(self.path): return
+        pack_file = open(self.path, "rb")
+        try:
+            data = mmap.mmap(pack_file.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            pack_file.close()
+        magic, version, count, symbols_len = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            data.close()
+            return
+        offset = HEADER.size
+        self.symbols = tuple(data[offset:offset + symbols_len].split(","))
+        offset += symbols_len
+        for i in range(count):
+            id_len, mtime, size, digest, record, length = ENTRY.unpack_from(data, offset)
+            offset += ENTRY.size
+            self.entries[data[offset:offset + id_len]] = (mtime, size, digest, record, length)
+            offset += id_len
+        self.data = data
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+        self.entries = {}
+
+    def fresh(self, level_id, stat):
+        '''The pack entry of a level if its source hasn't changed since, or None'''
+        entry = self.entries.get(level_id)
+        if entry is None: return None
+        if entry[:2] == (stat.st_mtime, stat.st_size): return entry
+        # Touched, but maybe not changed
+        digest = hashlib.sha1(read_file(os.path.join(self.directory, level_id))).digest()
+        if digest != entry[2]: return None
+        return entry
+
+    def load(self, level_id):
+        '''
+        The level dict of a level, from the pack if it's up to date there.
+        Raises LevelError if the level isn't valid.
+        '''
+        path = os.path.join(self.directory, level_id)
+        entry = self.fresh(level_id, os.stat(path))
+        if entry is None: return compile_level(read_file(path), level_id)
+        return decode(self.data, entry[3], self.symbols)
+
+    def record(self, entry):
+        return self.data[entry[3]:entry[3] + entry[4]]
+
+    def update(self):
+        '''
+        Compile the levels of the directory that changed since the pack was
+        written and drop the removed ones. Invalid levels are left out of
+        the pack. Returns the ids of the levels compiled and {level id: error}.
+        '''
+        compiled = []
+        errors = {}
+        # (level id, mtime, size, SHA-1, record)
+        levels = []
+        changed = False
+        for level_id in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, level_id)
+            if level_id.startswith(".") or not os.path.isfile(path): continue
+            stat = os.stat(path)
+            entry = self.entries.get(level_id)
+            if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+                levels.append((level_id, stat.st_mtime, stat.st_size, entry[2], self.record(entry)))
+                continue
+            source = read_file(path)
+            digest = hashlib.sha1(source).digest()
+            if entry is not None and entry[2] == digest:
+                levels.append((level_id, stat.st_mtime, stat.st_size, digest, self.record(entry)))
+                changed = True
+                continue
+            try:
+                record = encode(compile_level(source, level_id))
+            except LevelError, error:
+                errors[level_id] = str(error)
+                continue
+            levels.append((level_id, stat.st_mtime, stat.st_size, digest, record))
+            compiled.append(level_id)
+            changed = True
+        if changed or len(levels) != len(self.entries):
+            self.write(levels)
+        return compiled, errors
+
+    def write(self, levels):
+        symbols = ",".join(SYMBOLS)
+        index = []
+        offset = HEADER.size + len(symbols)
+        for level_id, mtime, size, digest, record in levels:
+            offset += ENTRY.size + len(level_id)
+        records = []
+        for level_id, mtime, size, digest, record in levels:
+            index.append(ENTRY.pack(len(level_id), mtime, size, digest, offset, len(record)) + level_id)
+            records.append(record)
+            offset += len(record)
+        data = HEADER.pack(MAGIC, VERSION, len(levels), len(symbols)) + symbols + "".join(index) + "".join(records)
+        # Windows can't replace a file that is mapped
+        self.close()
+        write_atomic(self.path, data)
+        self.open()
+
+
+def main(args = None):
+    if args is None: args = sys.argv[1:]
+    directory = args[0] if args else "levels"
+    cache = LevelCache(directory)
+    compiled, errors = cache.update()
+    for level_id in compiled:
+        print "Compiled %s" % level_id
+    for level_id in sorted(errors):
+        print errors[level_id]
+    print "%i levels in %s" % (len(cache.entries), cache.path)
+    cache.close()
+    if errors: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
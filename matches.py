@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+#       Match detection of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Finding the matches a placed figure makes.
+
+A figure cell makes a match when 2 or more cells next to it in a vertical
+or horizontal line hold the same element (spoilt or not) and are not locked.
+Figure cells are handled one after another, so cells destroyed by an earlier
+figure cell don't count for the later ones.
+
+With NumPy the runs of equal cells through the figure cells are found in
+one vectorized pass over the rows and columns the figure spans in the board's
+int8 codes (Board.codes), otherwise the bitmasks are walked cell by cell.
+Both give exactly the same result.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from board import LOCKED
+
+
+class Runs(object):
+    '''
+    Extents of the runs of equal match codes through the given cells, along
+    their rows and columns. All of them are found in one vectorized pass
+    over the rows and the columns the cells span.
+    '''
+    def __init__(self, codes, cells):
+        rows = [row for row, col in cells]
+        cols = [col for row, col in cells]
+        top, left = min(rows), min(cols)
+        r_first, r_last = self.bounds(codes[top:max(rows) + 1])
+        c_first, c_last = self.bounds(codes[:, left:max(cols) + 1].T)
+        # (row, col, vertical) -> (first, last) position of the run along its line
+        self.extents = {}
+        rows_in, cols_in = numpy.array(rows) - top, numpy.array(cols) - left
+        horizontal = zip(r_first[rows_in, cols].tolist(), r_last[rows_in, cols].tolist())
+        vertical = zip(c_first[cols_in, rows].tolist(), c_last[cols_in, rows].tolist())
+        for i, (row, col) in enumerate(cells):
+            self.extents[row, col, False] = horizontal[i]
+            self.extents[row, col, True] = vertical[i]
+
+    @staticmethod
+    def bounds(lines):
+        '''
+        For every element of a 2d array, the first and the last index
+        along its row of the run of equal values it belongs to
+        '''
+        length = lines.shape[1]
+        index = numpy.arange(length)
+        starts = numpy.ones(lines.shape, bool)
+        starts[:, 1:] = lines[:, 1:] != lines[:, :-1]
+        ends = numpy.ones(lines.shape, bool)
+        ends[:, :-1] = starts[:, 1:]
+        first = numpy.maximum.accumulate(numpy.where(starts, index, 0), axis = 1)
+        last = numpy.minimum.accumulate(numpy.where(ends, index, length - 1)[:, ::-1], axis = 1)[:, ::-1]
+        return first, last
+
+    def extent(self, row, col, vertical):
+        '''(first, last) position along its line of the run holding (row, col)'''
+        return self.extents[row, col, vertical]
+
+
+def run_neighbours(runs, row, col, d_row, d_col, cleared):
+    '''Cells of the run through (row, col) next to it in one line, up to the first cleared cell'''
+    first, last = runs.extent(row, col, bool(d_row))
+    pos = row if d_row else col
+    d_coords = []
+    for step, end in ((-1, first), (1, last)):
+        n_row, n_col = row, col
+        for i in range(abs(end - pos)):
+            n_row, n_col = n_row + step * d_row, n_col + step * d_col
+            if (n_row, n_col) in cleared: break
+            d_coords.append((n_row, n_col))
+    return d_coords
+
+
+def bit_neighbours(board, row, col, cell, d_row, d_col, cleared):
+    '''The same as run_neighbours(), walking the board's bitmasks'''
+    matching = board.matching(cell)
+    d_coords = []
+    for step in (-1, 1):
+        n_row, n_col = row + step * d_row, col + step * d_col
+        while board.inside(n_row, n_col) and matching & board.bit(n_row, n_col) \
+                and (n_row, n_col) not in cleared:
+            d_coords.append((n_row, n_col))
+            n_row, n_col = n_row + step * d_row, n_col + step * d_col
+    return d_coords
+
+
+def find_matches(board, placed):
+    '''
+    Find the matches made by figure cells already put on the board.
+    "placed" is a list of ((row, col), value) in the order the cells are
+    handled. Nothing on the board is changed.
+    Returns (cells to clear, score, bonus, goal), where goal is
+    {element: number of lines of it}.
+    '''
+    runs = None
+    if numpy is not None and board.codes is not None and placed:
+        runs = Runs(board.codes, [coords for coords, cell in placed])
+
+    cleared = set()
+    score = bonus = 0
+    goal = {}
+    for (row, col), cell in placed:
+        # A locked cell makes no matches
+        if cell[-1] == LOCKED: continue
+        match_found = False
+        # Vertical line first, then horizontal
+        for d_row, d_col in ((1, 0), (0, 1)):
+            if runs is not None:
+                d_coords = run_neighbours(runs, row, col, d_row, d_col, cleared)
+            else:
+                d_coords = bit_neighbours(board, row, col, cell, d_row, d_col, cleared)
+            counter = len(d_coords)
+            if counter < 2: continue
+
+            match_found = True
+            goal[cell[0]] = goal.get(cell[0], 0) + 1
+            cleared.update(d_coords)
+            score += 5 * counter
+            bonus += counter - 2
+
+        # If there was a match, the cell itself is destroyed too
+        if match_found: cleared.add((row, col))
+    return cleared, score, bonus, goal
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+#       Profiling of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Where the time of a frame goes.
+
+A frame is one pass of the level loop: handling the events that came in
+and aging metal (waiting for events doesn't count). Phases of a frame are
+timed with begin()/end() or "with profiler.phase(name)", and can nest:
+the time of a phase doesn't include the phases inside it. Frame times and
+phase times go to rolling histograms of the last WINDOW samples, counters
+(blits, surface allocations, updated rects) are kept per frame.
+
+With a trace file, every phase and the counters of every frame are also
+written in the Chrome trace event format, which chrome://tracing and
+Perfetto open.
+'''
+
+import collections
+import json
+import math
+import time
+
+# Samples kept by a rolling histogram
+WINDOW = 600
+# Histogram buckets: BUCKETS_PER_OCTAVE per doubling of microseconds, up to 2 ** OCTAVES us
+BUCKETS_PER_OCTAVE = 4
+OCTAVES = 21
+BUCKETS = BUCKETS_PER_OCTAVE * OCTAVES
+
+
+def bucket_of(seconds):
+    micro = seconds * 1e6
+    if micro <= 1: return 0
+    return min(BUCKETS - 1, int(math.log(micro, 2) * BUCKETS_PER_OCTAVE))
+
+
+def bucket_limit(bucket):
+    '''Upper limit of a bucket, in seconds'''
+    return 2 ** (float(bucket + 1) / BUCKETS_PER_OCTAVE) / 1e6
+
+
+class RollingHistogram(object):
+    '''Logarithmic histogram of the last "size" durations'''
+    def __init__(self, size = WINDOW):
+        self.size = size
+        # Buckets of the samples, the oldest first
+        self.samples = collections.deque()
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        bucket = bucket_of(seconds)
+        self.samples.append(bucket)
+        self.buckets[bucket] += 1
+        if len(self.samples) > self.size:
+            self.buckets[self.samples.popleft()] -= 1
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, percent):
+        '''The duration "percent" % of the samples are within (up to the bucket size), in seconds'''
+        if not self.samples: return 0.0
+        rank = int(math.ceil(len(self.samples) * percent / 100.0))
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank: return bucket_limit(bucket)
+        return bucket_limit(BUCKETS - 1)
+
+
+class Phase(object):
+    '''"with" block timing a phase'''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.begin(self.name)
+
+    def __exit__(self, *exc_info):
+        self.profiler.end()
+
+
+class Profiler(object):
+    def __init__(self, trace = None):
+        self.frames = RollingHistogram()
+        # phase -> RollingHistogram of its own time
+        self.phases = {}
+        self._phase_blocks = {}
+        # Open phases: [name, start, time of the phases inside it]
+        self.stack = []
+        self.frame_start = None
+        # Ends of the frames of the last second
+        self.frame_ends = collections.deque()
+        # counter -> count in the frame going on, and in the last finished frame
+        self.counters = {}
+        self.last_counters = {}
+        self.trace = None
+        self.trace_events = 0
+        self.origin = time.time()
+        if trace:
+            self.trace = open(trace, "wb")
+            self.trace.write("[\n")
+
+    def phase(self, name):
+        if name not in self._phase_blocks:
+            self._phase_blocks[name] = Phase(self, name)
+        return self._phase_blocks[name]
+
+    def begin(self, name):
+        self.stack.append([name, time.time(), 0.0])
+
+    def end(self):
+        name, start, nested = self.stack.pop()
+        duration = time.time() - start
+        if name not in self.phases: self.phases[name] = RollingHistogram()
+        self.phases[name].add(duration - nested)
+        if self.stack: self.stack[-1][2] += duration
+        if self.trace:
+            self.write_trace({"name": name, "ph": "X", "ts": self.micro(start), "dur": duration * 1e6})
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_frame(self):
+        self.frame_start = time.time()
+
+    def end_frame(self):
+        now = time.time()
+        self.frames.add(now - self.frame_start)
+        self.frame_ends.append(now)
+        while self.frame_ends[0] < now - 1:
+            self.frame_ends.popleft()
+        if self.trace and self.counters:
+            self.write_trace({"name": "frame", "ph": "C", "ts": self.micro(now), "args": self.counters})
+        self.last_counters = self.counters
+        self.counters = {}
+
+    def fps(self):
+        '''Frames finished during the last second'''
+        while self.frame_ends and self.frame_ends[0] < time.time() - 1:
+            self.frame_ends.popleft()
+        return len(self.frame_ends)
+
+    def slowest(self, percent = 99):
+        '''(name, duration) of the phase with the longest percentile, or None'''
+        worst = None
+        for name, histogram in self.phases.items():
+            duration = histogram.percentile(percent)
+            if worst is None or duration > worst[1]: worst = (name, duration)
+        return worst
+
+    def micro(self, seconds):
+        return (seconds - self.origin) * 1e6
+
+    def write_trace(self, event):
+        event["pid"] = event["tid"] = 1
+        if self.trace_events: self.trace.write(",\n")
+        self.trace.write(json.dumps(event))
+        self.trace_events += 1
+
+    def close(self):
+        if self.trace:
+            self.trace.write("\n]\n")
+            self.trace.close()
+            self.trace = None
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+#
+#       Player profiles of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+All player profiles in one sqlite database.
+
+A profile is what used to be the "<name>_progress" file: total score,
+locked levels, researched substances and their costs. On top of that the
+database keeps the best score of every level, the history of played levels
+and the levels left in the middle (see Engine.snapshot()). Profiles are
+looked up by name through an index, so switching between thousands of
+players costs the same as between two.
+
+The game still works with a profile as the dict it used to read from the
+progress file, see ProfileStore.load() and ProfileStore.save().
+Old progress files are imported by migrate_files().
+
+Like the settings files (see storage.py), profiles are written on a
+background thread, so a commit waiting for the disk never stalls the
+game: the thread has a connection of its own and makes the writes in the
+order they were asked for. Reading waits for the writes asked for before,
+so it always sees them.
+'''
+
+import copy
+import glob
+import json
+import os.path
+import sqlite3
+import threading
+import time
+
+import storage
+
+# Version 2: suspended levels
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE profiles (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    score INTEGER NOT NULL DEFAULT 0,
+    costs TEXT NOT NULL DEFAULT '{}',
+    created REAL NOT NULL,
+    last_played REAL NOT NULL
+);
+CREATE INDEX profiles_by_last_played ON profiles (last_played);
+
+CREATE TABLE levels (
+    profile INTEGER NOT NULL REFERENCES profiles (id),
+    level INTEGER NOT NULL,
+    locked INTEGER NOT NULL DEFAULT 0,
+    best_score INTEGER,
+    PRIMARY KEY (profile, level)
+);
+
+CREATE TABLE research (
+    profile INTEGER NOT NULL REFERENCES profiles (id),
+    substance TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (profile, substance)
+);
+
+CREATE TABLE history (
+    id INTEGER PRIMARY KEY,
+    profile INTEGER NOT NULL REFERENCES profiles (id),
+    level INTEGER NOT NULL,
+    won INTEGER NOT NULL,
+    score INTEGER NOT NULL,
+    played REAL NOT NULL
+);
+CREATE INDEX history_by_profile ON history (profile, played);
+"""
+
+SUSPENDED = """
+CREATE TABLE suspended (
+    profile INTEGER NOT NULL REFERENCES profiles (id),
+    level TEXT NOT NULL,
+    state TEXT NOT NULL,
+    saved REAL NOT NULL,
+    PRIMARY KEY (profile, level)
+);
+"""
+
+# version -> script bringing a database of that version to the next one
+UPGRADES = {
+    1: SUSPENDED,
+    }
+
+PROGRESS_SUFFIX = "_progress"
+
+
+def profile_id(db, name):
+    row = db.execute("SELECT id FROM profiles WHERE name = ?", (name,)).fetchone()
+    if row is None: return None
+    return row[0]
+
+
+class Writer(object):
+    '''
+    Makes the writes of a database on a thread with a connection of its
+    own, one after another, each of them committed.
+    Call flush() to wait until all of them are made, close() when done.
+    '''
+    def __init__(self, path):
+        self.path = path
+        # (function, args) of the writes to make
+        self.pending = []
+        self.writing = False
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run, name = "profiles")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, function, *args):
+        '''Call function(db, *args) on the thread and commit'''
+        self.condition.acquire()
+        try:
+            self.pending.append((function, args))
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        '''Wait until all writes are made'''
+        self.condition.acquire()
+        try:
+            while (self.pending or self.writing) and self.thread.is_alive():
+                self.condition.wait(0.1)
+        finally:
+            self.condition.release()
+
+    def close(self):
+        '''Make everything that's pending and stop the thread'''
+        self.flush()
+        self.condition.acquire()
+        try:
+            self.closing = True
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        self.thread.join()
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        condition = self.condition
+        while True:
+            condition.acquire()
+            try:
+                while not self.pending and not self.closing:
+                    condition.wait()
+                if not self.pending:
+                    break
+                function, args = self.pending.pop(0)
+                self.writing = True
+            finally:
+                condition.release()
+
+            try:
+                function(db, *args)
+                db.commit()
+            except sqlite3.Error, error:
+                db.rollback()
+                print "Could not save to %s: %s" % (self.path, error)
+
+            condition.acquire()
+            try:
+                self.writing = False
+                condition.notify_all()
+            finally:
+                condition.release()
+        db.close()
+
+
+class ProfileStore(object):
+    def __init__(self, path = "profiles.db"):
+        self.db = sqlite3.connect(path)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError("%s was made by a newer version of the game" % path)
+        if version == 0:
+            self.db.executescript(SCHEMA + SUSPENDED)
+        else:
+            for upgrade in range(version, SCHEMA_VERSION):
+                self.db.executescript(UPGRADES[upgrade])
+        if version != SCHEMA_VERSION:
+            self.db.execute("PRAGMA user_version = %i" % SCHEMA_VERSION)
+            self.db.commit()
+        # Made after the schema is, the writer's connection sees it
+        self.writer = Writer(path)
+
+    def close(self):
+        self.writer.close()
+        self.db.close()
+
+    def profile_id(self, name):
+        self.writer.flush()
+        return profile_id(self.db, name)
+
+    def exists(self, name):
+        return self.profile_id(name) is not None
+
+    def names(self, limit = None):
+        '''Profile names, the most recently played first'''
+        self.writer.flush()
+        query = "SELECT name FROM profiles ORDER BY last_played DESC"
+        if limit is not None: query += " LIMIT %i" % limit
+        return [row[0] for row in self.db.execute(query)]
+
+    def load(self, name):
+        '''
+        The profile in the format of the old progress files:
+        {"score", "locked", "substances", "costs"}. None if there's no such profile.
+        '''
+        self.writer.flush()
+        row = self.db.execute("SELECT id, score, costs FROM profiles WHERE name = ?", (name,)).fetchone()
+        if row is None: return None
+        profile, score, costs = row
+        locked = [level for level, in self.db.execute(
+            "SELECT level FROM levels WHERE profile = ? AND locked ORDER BY level", (profile,))]
+        substances = [substance for substance, in self.db.execute(
+            "SELECT substance FROM research WHERE profile = ? ORDER BY position", (profile,))]
+        return {
+            "score": score,
+            "locked": locked,
+            "substances": substances,
+            "costs": json.loads(costs),
+            }
+
+    def save(self, name, progress):
+        '''
+        Create or update a profile from a dict in the format of load().
+        The dict is copied right away, so it can be changed after this call.
+        '''
+        self.writer.write(self._save, name, copy.deepcopy(progress), time.time())
+
+    @staticmethod
+    def _save(db, name, progress, now):
+        profile = profile_id(db, name)
+        if profile is None:
+            profile = db.execute("INSERT INTO profiles (name, created, last_played) VALUES (?, ?, ?)",
+                                 (name, now, now)).lastrowid
+        db.execute("UPDATE profiles SET score = ?, costs = ?, last_played = ? WHERE id = ?",
+                   (progress["score"], json.dumps(progress["costs"]), now, profile))
+        db.execute("UPDATE levels SET locked = 0 WHERE profile = ?", (profile,))
+        for level in progress["locked"]:
+            db.execute("INSERT OR IGNORE INTO levels (profile, level) VALUES (?, ?)", (profile, level))
+            db.execute("UPDATE levels SET locked = 1 WHERE profile = ? AND level = ?", (profile, level))
+        db.execute("DELETE FROM research WHERE profile = ?", (profile,))
+        for position, substance in enumerate(progress["substances"]):
+            db.execute("INSERT INTO research (profile, substance, position) VALUES (?, ?, ?)",
+                       (profile, substance, position))
+
+    def record_play(self, name, level, won, score):
+        '''
+        Add a played level to the history of a profile and update the
+        best score of the level if it was won
+        '''
+        self.writer.write(self._record_play, name, level, won, score, time.time())
+
+    @staticmethod
+    def _record_play(db, name, level, won, score, now):
+        profile = profile_id(db, name)
+        db.execute("INSERT INTO history (profile, level, won, score, played) VALUES (?, ?, ?, ?, ?)",
+                   (profile, level, int(won), score, now))
+        if won:
+            db.execute("INSERT OR IGNORE INTO levels (profile, level) VALUES (?, ?)", (profile, level))
+            db.execute("UPDATE levels SET best_score = ? WHERE profile = ? AND level = ? "
+                       "AND (best_score IS NULL OR best_score < ?)", (score, profile, level, score))
+        db.execute("UPDATE profiles SET last_played = ? WHERE id = ?", (now, profile))
+
+    def best_scores(self, name):
+        '''{level: best score} of the levels a profile has won'''
+        return dict(self.db.execute(
+            "SELECT level, best_score FROM levels WHERE profile = ? AND best_score IS NOT NULL",
+            (self.profile_id(name),)).fetchall())
+
+    def suspend(self, name, level_id, state):
+        '''
+        Keep the snapshot of a level left in the middle, instead of the one
+        kept before. Nothing is kept for a name without a profile.
+        '''
+        self.writer.write(self._suspend, name, level_id, json.dumps(state), time.time())
+
+    @staticmethod
+    def _suspend(db, name, level_id, state, now):
+        profile = profile_id(db, name)
+        if profile is None: return
+        db.execute("INSERT OR REPLACE INTO suspended (profile, level, state, saved) VALUES (?, ?, ?, ?)",
+                   (profile, level_id, state, now))
+
+    def suspended(self, name, level_id):
+        '''The snapshot of a level left in the middle, or None'''
+        row = self.db.execute("SELECT state FROM suspended WHERE profile = ? AND level = ?",
+                              (self.profile_id(name), level_id)).fetchone()
+        if row is None: return None
+        return json.loads(row[0])
+
+    def drop_suspended(self, name, level_id = None):
+        '''Forget a level left in the middle, or all of them if no level is given'''
+        self.writer.write(self._drop_suspended, name, level_id)
+
+    @staticmethod
+    def _drop_suspended(db, name, level_id):
+        if level_id is None:
+            db.execute("DELETE FROM suspended WHERE profile = ?", (profile_id(db, name),))
+        else:
+            db.execute("DELETE FROM suspended WHERE profile = ? AND level = ?", (profile_id(db, name), level_id))
+
+    def history(self, name, limit = 20):
+        '''The last played levels of a profile as (level, won, score, time), the latest first'''
+        return self.db.execute(
+            "SELECT level, won, score, played FROM history WHERE profile = ? ORDER BY played DESC LIMIT ?",
+            (self.profile_id(name), limit)).fetchall()
+
+
+def migrate_files(store, directory = "."):
+    '''
+    Import "<name>_progress" files of profiles the store doesn't have yet.
+    The files are left as they are. Returns the names imported.
+    '''
+    imported = []
+    for path in sorted(glob.glob(os.path.join(directory, "*" + PROGRESS_SUFFIX))):
+        name = os.path.basename(path)[:-len(PROGRESS_SUFFIX)]
+        if not name or store.exists(name): continue
+        progress_file = open(path, "rb")
+        try:
+            progress = storage.upgrade(json.loads(progress_file.read()))
+        except ValueError, error:
+            print "Could not import %s: %s" % (path, error)
+            continue
+        finally:
+            progress_file.close()
+        store.save(name, progress)
+        imported.append(name)
+    return imported
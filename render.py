@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#
+#       Drawing helpers for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import collections
+
+import pygame
+
+from engine import ELEMENTS
+
+CELL_SIZE = 32
+# Most cells shown at once, bigger boards are scrolled
+VIEW_ROWS = VIEW_COLS = 15
+# Figure cells that can't be placed are darkened by this color
+BLOCKED_TINT = (50, 50, 50)
+
+
+class AllocationCounter(object):
+    '''
+    Counts surfaces created through it. Counting is off unless the game
+    is started with --debug.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.count = 0
+
+    def copy(self, surface):
+        if self.enabled: self.count += 1
+        return surface.copy()
+
+    def new(self, size, flags = 0, depth = 0):
+        if self.enabled: self.count += 1
+        if not depth: return pygame.Surface(size, flags)
+        return pygame.Surface(size, flags, depth)
+
+allocations = AllocationCounter()
+
+
+class TextureAtlas(object):
+    '''
+    Sprites of the same size packed into one surface. sprite() returns a
+    subsurface: it is blitted like any other surface, but shares the pixels
+    of the atlas.
+    '''
+    def __init__(self, images, size, columns = 8):
+        '''"images" is a list of (key, surface)'''
+        rows = (len(images) + columns - 1) // columns
+        surface = allocations.new((columns * size, max(rows, 1) * size), pygame.SRCALPHA, 32)
+        # key -> rect of the sprite in the atlas
+        self.rects = {}
+        for i, (key, image) in enumerate(images):
+            rect = pygame.Rect((i % columns) * size, (i // columns) * size, size, size)
+            # The atlas is transparent black, so MAX copies the pixels as they are
+            surface.blit(image, rect, None, pygame.BLEND_RGBA_MAX)
+            self.rects[key] = rect
+        self.surface = surface.convert_alpha()
+        self.sprites = {}
+        for key, rect in self.rects.items():
+            self.sprites[key] = self.surface.subsurface(rect)
+
+    def sprite(self, key):
+        return self.sprites[key]
+
+
+class SpriteCache(object):
+    '''
+    Element sprites in their normal and "blocked" (darkened) variants, all
+    packed into one texture atlas. Both are built once, so showing a figure
+    never copies images.
+    '''
+    def __init__(self, images, names):
+        names = sorted(names)
+        self.atlas = TextureAtlas([(name, images[name]) for name in names] +
+                                  [((name, True), images[name]) for name in names], CELL_SIZE)
+        for name in names:
+            self.atlas.surface.fill(BLOCKED_TINT, self.atlas.rects[name, True], pygame.BLEND_SUB)
+
+    def sprite(self, name, blocked = False):
+        if blocked: return self.atlas.sprite((name, True))
+        return self.atlas.sprite(name)
+
+
+class TextCache(object):
+    '''
+    Rendered text, keyed by (font, text, color). The "size" most recently
+    used labels are kept.
+
+    A label ending with a number ("Score: 125") that isn't cached is put
+    together from the rendering of its beginning, cached like any label,
+    and of the digits, which are never dropped. So a changing counter
+    doesn't render text at all, and labels with numbers in the middle
+    ("Level rank: 3 of 40") can't make the cache grow without end.
+    '''
+    DIGITS = "0123456789"
+
+    def __init__(self, size = 256):
+        self.size = size
+        # (font, text, color) -> surface, the least recently used first
+        self.labels = collections.OrderedDict()
+        # Single digits: (font, digit, color) -> surface
+        self.glyphs = {}
+        self.hits = self.misses = 0
+        # Calls to font.render()
+        self.renders = 0
+
+    def render(self, font, text, color):
+        key = font, text, color
+        surface = self.labels.pop(key, None)
+        if surface is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            beginning = text.rstrip(self.DIGITS)
+            if beginning != text:
+                surface = self.compose(font, beginning, text[len(beginning):], color)
+            else:
+                surface = self.render_text(font, text, color)
+        self.store(key, surface)
+        return surface
+
+    def store(self, key, surface):
+        '''Keep a surface as the most recently used, dropping the least recently used one if full'''
+        self.labels[key] = surface
+        if len(self.labels) > self.size:
+            self.labels.popitem(last = False)
+
+    def render_text(self, font, text, color):
+        self.renders += 1
+        return font.render(text, True, color)
+
+    def glyph(self, font, digit, color):
+        key = font, digit, color
+        if key not in self.glyphs:
+            self.glyphs[key] = self.render_text(font, digit, color)
+        return self.glyphs[key]
+
+    def compose(self, font, beginning, digits, color):
+        '''One surface with the cached renderings of "beginning" and "digits" side by side'''
+        images = [self.glyph(font, digit, color) for digit in digits]
+        if beginning:
+            key = font, beginning, color
+            image = self.labels.pop(key, None)
+            if image is None: image = self.render_text(font, beginning, color)
+            self.store(key, image)
+            images.insert(0, image)
+        width = sum([image.get_width() for image in images])
+        height = max([image.get_height() for image in images])
+        surface = allocations.new((width, height), pygame.SRCALPHA, 32)
+        x = 0
+        for image in images:
+            # The surface is transparent black, so MAX copies the pixels as they are
+            surface.blit(image, (x, 0), None, pygame.BLEND_RGBA_MAX)
+            x += image.get_width()
+        return surface
+
+    def stats(self):
+        total = max(self.hits + self.misses, 1)
+        return "text cache: %i hits, %i misses (%.1f%% hits), %i labels, %i glyphs, %i renders" % (
+            self.hits, self.misses, 100.0 * self.hits / total, len(self.labels), len(self.glyphs), self.renders)
+
+
+def frame_surface(frame, width, height):
+    '''
+    The frame image (CELL_SIZE thick on every side) resized to go around a
+    width x height area: corners are kept as they are, sides are cut or
+    repeated.
+    '''
+    size = CELL_SIZE
+    src_w, src_h = frame.get_width() - 2 * size, frame.get_height() - 2 * size
+    surface = allocations.new((width + 2 * size, height + 2 * size), pygame.SRCALPHA, 32)
+    for src_x, x, w in ((0, 0, size), (size, size, width), (size + src_w, size + width, size)):
+        for src_y, y, h in ((0, 0, size), (size, size, height), (size + src_h, size + height, size)):
+            # Repeat the piece of the frame if the area is bigger than the image
+            piece_w = min(w, src_w) if src_x == size else w
+            piece_h = min(h, src_h) if src_y == size else h
+            for dx in range(0, w, piece_w):
+                for dy in range(0, h, piece_h):
+                    surface.blit(frame, (x + dx, y + dy),
+                                 (src_x, src_y, min(piece_w, w - dx), min(piece_h, h - dy)))
+    return surface
+
+
+class GridRenderer(object):
+    '''
+    Draws the part of the board that is in view.
+    The view is at most VIEW_ROWS x VIEW_COLS cells, centered in "area" (a
+    screen rect), and can be scrolled over bigger boards. Only the cells
+    in view that changed since the last frame are redrawn and sent to the
+    display: cells changed on the board (placements, matches, aging) and
+    cells covered by the figure and its shadow now or in the last frame.
+    So the cost of a frame depends on what is on the screen and what
+    changed, not on the size of the board.
+
+    Positions on the grid area (mouse, shadow, figure images) are in pixels
+    from the top left corner of the view, cells are (row, col) of the board.
+    '''
+    def __init__(self, screen, images, board, area):
+        self.screen = screen
+        self.images = images
+        self.board = board
+
+        self.rows = min(board.rows, VIEW_ROWS)
+        self.cols = min(board.cols, VIEW_COLS)
+        # Board cell in the top left corner of the view
+        self.top = self.left = 0
+
+        self.grid_area = allocations.new((self.cols * CELL_SIZE, self.rows * CELL_SIZE))
+        self.rect = self.grid_area.get_rect(center = pygame.Rect(area).center)
+        self.offset = self.rect.topleft
+        # The grid texture is repeated over big boards
+        self.texture = self.images['grid']
+        self.texture_rows = self.texture.get_height() // CELL_SIZE
+        self.texture_cols = self.texture.get_width() // CELL_SIZE
+        # Borders never change during a level, so the grid texture and the
+        # borders in view are drawn once into this layer, and again only
+        # when the view scrolls. Every cell is then restored from it.
+        self.static = allocations.new((self.cols * CELL_SIZE, self.rows * CELL_SIZE))
+        self.draw_static()
+
+        # Cells covered by the figure and its shadow in the last frame
+        self.covered = set()
+        # Number of pixels sent to the display in the last frame, and of blits made for it
+        self.pixels = 0
+        self.blits = 0
+
+    def in_view(self, row, col):
+        return self.top <= row < self.top + self.rows and self.left <= col < self.left + self.cols
+
+    def cell_at(self, pos):
+        '''Board cell under a position on the grid area'''
+        return self.top + pos[1] // CELL_SIZE, self.left + pos[0] // CELL_SIZE
+
+    def cell_pos(self, row, col):
+        '''Position of a board cell on the grid area'''
+        return (col - self.left) * CELL_SIZE, (row - self.top) * CELL_SIZE
+
+    def scroll(self, d_rows, d_cols):
+        '''
+        Move the view by given number of cells, as far as the board goes.
+        Returns True if it moved; the view has to be redrawn then.
+        '''
+        top = max(0, min(self.board.rows - self.rows, self.top + d_rows))
+        left = max(0, min(self.board.cols - self.cols, self.left + d_cols))
+        if (top, left) == (self.top, self.left): return False
+        self.top, self.left = top, left
+        self.draw_static()
+        return True
+
+    def draw_static(self):
+        '''Draw the grid texture and the borders in view into the static layer'''
+        grid = self.board.grid
+        for row in range(self.top, self.top + self.rows):
+            for col in range(self.left, self.left + self.cols):
+                pos = self.cell_pos(row, col)
+                tile = ((col % self.texture_cols) * CELL_SIZE, (row % self.texture_rows) * CELL_SIZE,
+                        CELL_SIZE, CELL_SIZE)
+                self.static.blit(self.texture, pos, tile)
+                if grid[row][col] == "b":
+                    self.static.blit(self.images["border"], pos)
+
+    def draw_cell(self, row, col):
+        '''Draw a single cell of the board into the grid area'''
+        cell = self.board.grid[row][col]
+        pos = self.cell_pos(row, col)
+        self.grid_area.blit(self.static, pos, (pos[0], pos[1], CELL_SIZE, CELL_SIZE))
+        self.blits += 1
+        if cell != "0" and cell != "b":
+            self.grid_area.blit(self.images[ELEMENTS[cell]], pos)
+            self.blits += 1
+
+    def background(self, bg_image, frame):
+        '''
+        Compose the level background: the background image and the frame
+        around the view, all in one surface.
+        '''
+        background = allocations.copy(bg_image)
+        background.blit(frame_surface(frame, self.rect.width, self.rect.height),
+                        (self.rect.left - CELL_SIZE, self.rect.top - CELL_SIZE))
+        return background
+
+    def footprint(self, shadow, figure_image):
+        '''Cells in view covered by the shadow and by the figure images (which don't have to be aligned to cells)'''
+        cells = set()
+        for x, y in shadow:
+            cells.add(self.cell_at((x, y)))
+        for image, (x, y) in figure_image.values():
+            for row in range(y // CELL_SIZE, (y + CELL_SIZE - 1) // CELL_SIZE + 1):
+                for col in range(x // CELL_SIZE, (x + CELL_SIZE - 1) // CELL_SIZE + 1):
+                    cells.add((self.top + row, self.left + col))
+        return set([(row, col) for row, col in cells
+                    if self.in_view(row, col) and self.board.inside(row, col)])
+
+    def redraw(self):
+        '''Draw the whole view and show it on the screen (without updating the display)'''
+        self.board.take_changes()
+        self.grid_area.blit(self.static, (0, 0))
+        self.blits = 2
+        grid = self.board.grid
+        for row in range(self.top, self.top + self.rows):
+            for col in range(self.left, self.left + self.cols):
+                cell = grid[row][col]
+                if cell != "0" and cell != "b":
+                    self.grid_area.blit(self.images[ELEMENTS[cell]], self.cell_pos(row, col))
+                    self.blits += 1
+        self.covered = set()
+        self.screen.blit(self.grid_area, self.offset)
+        self.pixels = self.rect.width * self.rect.height
+        return [self.rect]
+
+    def render(self, shadow=(), figure_image={}):
+        '''
+        Redraw dirty cells, draw the shadow and the figure over them and
+        blit the dirty cells to the screen.
+        Returns the list of screen rects that have to be updated.
+        '''
+        covered = self.footprint(shadow, figure_image)
+        changed = set([(row, col) for row, col in self.board.take_changes() if self.in_view(row, col)])
+        dirty = changed | self.covered | covered
+        self.covered = covered
+        self.blits = len(shadow) + len(figure_image) + len(dirty)
+
+        for row, col in dirty:
+            self.draw_cell(row, col)
+        for coords in shadow:
+            self.grid_area.blit(self.images['shadow'], coords)
+        for cell in figure_image.values():
+            self.grid_area.blit(*cell)
+
+        rects = []
+        for row, col in dirty:
+            area = pygame.Rect(self.cell_pos(row, col), (CELL_SIZE, CELL_SIZE))
+            rect = area.move(self.offset)
+            self.screen.blit(self.grid_area, rect, area)
+            rects.append(rect)
+        self.pixels = len(rects) * CELL_SIZE * CELL_SIZE
+        return rects
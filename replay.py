@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+#       Replays of "Alchemy: In search of the Philosopher's stone" levels.
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Recording and headless replaying of levels.
+
+A level is fully determined by its seed, the moments the engine looked at
+the clock and what the player did, so a replay stores just that:
+
+    header:  "ALRP", format version, length of the metadata
+    metadata: JSON with the level id, seed, initial score, substances, costs
+              and the snapshot a resumed level started from (see Engine.snapshot())
+    records: (tick, action, row, col, rotation, substance), 9 bytes each
+
+Run "python replay.py FILE" to replay a recorded level and print the result.
+'''
+
+import json
+import os.path
+import random
+import struct
+import sys
+
+from engine import Engine, ManualClock
+from history import History
+
+MAGIC = "ALRP"
+# Version 2: figures come from the polyomino table
+# Version 3: figures and aging have random streams of their own
+# Version 4: undo, redo and resumed levels
+VERSION = 4
+# Version 3 replays are played the same way
+READABLE = (3, 4)
+HEADER = struct.Struct("<4sBI")
+# Rows and columns are single bytes, enough for boards up to board.MAX_SIZE
+RECORD = struct.Struct("<IBBBBB")
+
+# Actions
+START = 0
+PLACE = 1
+SUBSTANCE = 2
+AGE = 3
+UNDO = 4
+REDO = 5
+
+
+class Recorder(object):
+    '''Collects engine actions. Set it as engine.recorder to record a level.'''
+    def __init__(self, level_id, seed, score = 0, substances = (), costs = None, state = None):
+        self.meta = {
+            "level": level_id,
+            "seed": seed,
+            "score": score,
+            "substances": list(substances),
+            "costs": costs or {},
+            "state": state,
+            }
+        # Records are packed right away, so a long level takes little memory
+        self.records = []
+
+    def record(self, tick, action, row = 0, col = 0, rotation = 0, substance = 0):
+        self.records.append(RECORD.pack(tick, action, row, col, rotation, substance))
+
+    def start(self, tick):
+        self.record(tick, START)
+
+    def place(self, tick, row, col, rotation):
+        self.record(tick, PLACE, row, col, rotation)
+
+    def substance(self, tick, index):
+        self.record(tick, SUBSTANCE, substance = index)
+
+    def age(self, tick):
+        self.record(tick, AGE)
+
+    def undo(self, tick):
+        self.record(tick, UNDO)
+
+    def redo(self, tick):
+        self.record(tick, REDO)
+
+    def dumps(self):
+        meta = json.dumps(self.meta)
+        return HEADER.pack(MAGIC, VERSION, len(meta)) + meta + "".join(self.records)
+
+    def save(self, path):
+        replay_file = open(path, "wb")
+        replay_file.write(self.dumps())
+        replay_file.close()
+
+
+def loads(data):
+    '''Return (metadata, list of records) of a replay'''
+    magic, version, meta_len = HEADER.unpack_from(data)
+    if magic != MAGIC or version not in READABLE:
+        raise ValueError("Not an Alchemy replay (or an unsupported version)")
+    offset = HEADER.size
+    meta = json.loads(data[offset:offset + meta_len])
+    offset += meta_len
+    records = []
+    while offset < len(data):
+        records.append(RECORD.unpack_from(data, offset))
+        offset += RECORD.size
+    return meta, records
+
+
+def load(path):
+    replay_file = open(path, "rb")
+    data = replay_file.read()
+    replay_file.close()
+    return loads(data)
+
+
+def load_level(level_id, levels_dir = "levels"):
+    level_file = open(os.path.join(levels_dir, level_id), "r")
+    level = json.loads(level_file.read())
+    level_file.close()
+    return level
+
+
+def play(meta, records, level = None):
+    '''
+    Replay a recorded level without any display.
+    Returns the engine in the state the level was left in.
+    '''
+    if level is None: level = load_level(meta["level"])
+    clock = ManualClock()
+    engine = Engine(level, meta["score"], meta["substances"], meta["costs"],
+                    clock = clock, rng = random.Random(meta["seed"]))
+    # Moves are kept the same way the game keeps them, so undo and redo do the same
+    history = History(engine)
+    for tick, action, row, col, rotation, substance in records:
+        clock.now = tick
+        if action == START:
+            engine.start(meta.get("state"))
+        elif action == PLACE:
+            while engine.rotation != rotation:
+                engine.rotate()
+            history.begin()
+            engine.place(row, col)
+            history.commit()
+        elif action == SUBSTANCE:
+            engine.use_substance(engine.substances[substance])
+        elif action == AGE:
+            engine.tick()
+        elif action == UNDO:
+            history.undo()
+        elif action == REDO:
+            history.redo()
+    return engine
+
+
+def main():
+    if len(sys.argv) < 2:
+        print "Usage: %s REPLAY_FILE" % sys.argv[0]
+        sys.exit(1)
+    meta, records = load(sys.argv[1])
+    engine = play(meta, records)
+    if engine.victory: result = "won"
+    elif engine.defeat: result = "lost"
+    else: result = "left"
+    print "%s (seed %i): %s after %i actions" % (meta["level"], meta["seed"], result, len(records))
+    print "Score: %i, bonus: %i" % (engine.score, engine.bonus)
+    print "Goal left: %s" % ", ".join(["%s %i" % (e, q) for e, q in sorted(engine.goal.items())])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+#
+#       Self-play simulator for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Play many seeded games of a level headlessly and report how hard it is.
+
+    python simulate.py 3 -n 1000 -p greedy
+    python alchemy.py simulate 3 -n 1000 -p greedy
+
+Games are spread over a process pool. A policy decides where every figure
+goes; see POLICIES.
+'''
+
+import multiprocessing
+import optparse
+import random
+import time
+
+from engine import Engine, ManualClock
+from replay import load_level
+
+
+def candidates(engine):
+    '''All legal moves for the current figure as (rotation, row, col)'''
+    moves = []
+    board = engine.board
+    for rotation, figure in enumerate(engine.figures):
+        for row, col in board.cells(board.placements(figure)):
+            moves.append((rotation, row, col))
+    return moves
+
+
+def figure_cells(figure, row, col):
+    '''Dict {(row, col): cell} of a figure placed at (row, col)'''
+    cells = {}
+    for rnum, c_row in enumerate(figure):
+        for cnum, cell in enumerate(c_row):
+            if cell: cells[row + rnum, col + cnum] = cell
+    return cells
+
+
+def match_value(engine, placed):
+    '''
+    Roughly how good it is to put the cells "placed" ({(row, col): cell})
+    on the board: the size of every line of 3 or more they would make,
+    doubled for elements the goal still needs. Cascades are ignored.
+    '''
+    board = engine.board
+
+    def value_at(row, col):
+        if (row, col) in placed: return placed[row, col]
+        if board.inside(row, col): return board.grid[row][col]
+        return ""
+
+    total = 0
+    for (row, col), cell in placed.items():
+        for d_row, d_col in ((1, 0), (0, 1)):
+            run = 1
+            for sign in (1, -1):
+                n_row, n_col = row + sign * d_row, col + sign * d_col
+                while True:
+                    value = value_at(n_row, n_col)
+                    if not value or value[0] != cell[0] or value[-1] == "l": break
+                    run += 1
+                    n_row, n_col = n_row + sign * d_row, n_col + sign * d_col
+            if run >= 3:
+                total += run * (2 if engine.goal.get(cell[0], 0) > 0 else 1)
+    return total
+
+
+def random_policy(engine, rng):
+    moves = candidates(engine)
+    if not moves: return None
+    return rng.choice(moves)
+
+
+def greedy_policy(engine, rng):
+    '''The move making the biggest matches right now, random among equals'''
+    scored = rank_moves(engine, rng)
+    if not scored: return None
+    return scored[0][2]
+
+
+def lookahead_policy(engine, rng, breadth = 5):
+    '''
+    Take the best few greedy moves and pick the one after which the next
+    figure has the best greedy move as well.
+    '''
+    scored = rank_moves(engine, rng)
+    if not scored: return None
+    board = engine.board
+    figures = engine.figures
+    next_figures = engine.next_figures
+    best, best_move = None, None
+    for value, tie, move in scored[:breadth]:
+        rotation, row, col = move
+        placed = figure_cells(figures[rotation], row, col)
+        taken = 0
+        for p_row, p_col in placed:
+            taken |= board.bit(p_row, p_col)
+        free = board.free & ~taken
+        next_value = 0
+        for figure in next_figures:
+            offsets, height, width = board.figure_shape(figure)
+            for n_row, n_col in board.cells(board.scan_placements(offsets, height, width, free)):
+                n_placed = figure_cells(figure, n_row, n_col)
+                n_placed.update(placed)
+                next_value = max(next_value, match_value(engine, n_placed) - value)
+        total = value + next_value
+        if best is None or total > best:
+            best, best_move = total, move
+    return best_move
+
+
+def rank_moves(engine, rng):
+    '''Legal moves as (value, tie breaker, move), best first'''
+    scored = []
+    figures = engine.figures
+    for move in candidates(engine):
+        rotation, row, col = move
+        value = match_value(engine, figure_cells(figures[rotation], row, col))
+        scored.append((value, rng.random(), move))
+    scored.sort(reverse = True)
+    return scored
+
+
+POLICIES = {
+    "random": random_policy,
+    "greedy": greedy_policy,
+    "lookahead": lookahead_policy,
+    }
+
+
+def play_game(level, seed, policy = "greedy", max_moves = 1000, think = 3):
+    '''
+    Play one game of a level and return a dict with the result.
+    "think" is how many seconds (of simulated time) every move takes,
+    metals age meanwhile.
+    '''
+    clock = ManualClock()
+    engine = Engine(level, clock = clock, rng = random.Random(seed))
+    rng = random.Random("policy %i" % seed)
+    choose = POLICIES[policy]
+    engine.start()
+    moves = 0
+    while not (engine.victory or engine.defeat) and moves < max_moves:
+        move = choose(engine, rng)
+        if move is None: break
+        rotation, row, col = move
+        while engine.rotation != rotation:
+            engine.rotate()
+        engine.place(row, col)
+        moves += 1
+        clock.advance(think)
+        engine.tick()
+    return {
+        "seed": seed,
+        "won": engine.victory,
+        "moves": moves,
+        "score": engine.score,
+        "bonus": engine.bonus,
+        }
+
+
+# Worker processes get the level once, not with every game
+_worker_level = None
+
+def _init_worker(level):
+    global _worker_level
+    _worker_level = level
+
+def _play(args):
+    return play_game(_worker_level, *args)
+
+
+def simulate(level, games, policy = "greedy", seed = 0, processes = None, max_moves = 1000, think = 3):
+    '''
+    Play "games" games of a level with seeds seed, seed+1, ... over a
+    process pool. Returns (list of results, seconds taken).
+    '''
+    tasks = [(seed + i, policy, max_moves, think) for i in range(games)]
+    start = time.time()
+    if processes == 1:
+        _init_worker(level)
+        results = map(_play, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (level,))
+        # Big enough chunks to keep the overhead low, small enough to balance the load
+        chunksize = max(1, games // (8 * (processes or multiprocessing.cpu_count())))
+        results = list(pool.imap_unordered(_play, tasks, chunksize))
+        pool.close()
+        pool.join()
+    return sorted(results, key = lambda result: result["seed"]), time.time() - start
+
+
+def distribution(values):
+    '''"mean, min / median / 90th percentile / max" of a list of numbers'''
+    if not values: return "-"
+    values = sorted(values)
+    def percentile(p):
+        return values[min(len(values) - 1, int(p * len(values)))]
+    return "%.1f, %i / %i / %i / %i" % (float(sum(values)) / len(values), values[0],
+                                        percentile(0.5), percentile(0.9), values[-1])
+
+
+def report(level_id, policy, results, seconds):
+    won = [result for result in results if result["won"]]
+    print "%s, %s policy: %i games in %.2f s (%.1f games/s)" % (
+        level_id, policy, len(results), seconds, len(results) / max(seconds, 1e-9))
+    print "Win rate:     %.1f%%" % (100.0 * len(won) / max(len(results), 1))
+    print "Moves to win: %s" % distribution([result["moves"] for result in won])
+    print "Score:        %s" % distribution([result["score"] for result in results])
+    print "Bonus:        %s" % distribution([result["bonus"] for result in results])
+
+
+def main(args = None):
+    parser = optparse.OptionParser(usage = "%prog [options] LEVEL  (a number or a file in levels/)")
+    parser.add_option("-n", "--games", type = "int", default = 100, help = "number of games [%default]")
+    parser.add_option("-p", "--policy", choices = sorted(POLICIES.keys()), default = "greedy",
+                      help = "placement policy: %s [%%default]" % ", ".join(sorted(POLICIES.keys())))
+    parser.add_option("-s", "--seed", type = "int", default = 0, help = "seed of the first game [%default]")
+    parser.add_option("-j", "--processes", type = "int", default = None, help = "worker processes [number of CPUs]")
+    parser.add_option("--moves", type = "int", default = 1000, help = "give up after this many moves [%default]")
+    parser.add_option("--think", type = "int", default = 3, help = "seconds every move takes [%default]")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("which level?")
+
+    level_id = args[0]
+    if level_id.isdigit(): level_id = "level_%s" % level_id
+    level = load_level(level_id)
+    results, seconds = simulate(level, options.games, options.policy, options.seed,
+                                options.processes, options.moves, options.think)
+    report(level_id, options.policy, results, seconds)
+
+if __name__ == '__main__':
+    main()
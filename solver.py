@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+#       Level solver for "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Exact search of a level for a fixed sequence of figures.
+
+    python solver.py 1 -s 7 -d 6
+    python solver.py 1 -s 7 -d 2 --score
+
+The figures are dealt from a list made in advance (figure_sequence()), the
+same the game deals for the seed, so every path through the game sees the
+same ones. Moves are played on a real Engine: matches, goal, aging and
+defeat all follow the game rules. Every move takes "think" seconds of the
+game clock, and the random part of aging after a move depends only on the
+seed and the number of figures dealt (see Engine.reseed()), so a position
+is fully described by the grid, the aging timers, the goal and the number
+of figures dealt.
+
+Moves are taken back with the engine's undo (see history.py), which only
+touches the cells and timers a move changed. Positions are identified by a
+Zobrist hash (random 64 bit keys XORed together), updated on every cell and
+timer change rather than computed anew. Searches are iterative deepening
+depth-first: depth 1, 2, ... until the goal is reached, so the first win
+found takes the fewest moves. A transposition table of bounded size (least
+recently used positions are dropped) remembers positions already searched,
+and positions whose remaining figures can't make enough lines for the goal
+are cut off.
+'''
+
+import collections
+import optparse
+import random
+import time
+
+from board import LOCKED
+from engine import Engine, ManualClock
+from history import History
+from replay import load_level
+from simulate import figure_cells, match_value
+
+# Positions kept in a transposition table
+TABLE_SIZE = 1 << 16
+
+
+class SearchLimit(Exception):
+    '''The search has looked at as many positions as it was allowed to'''
+
+
+def figure_sequence(level, seed, length):
+    '''
+    The first "length" figures the game deals on a level played with
+    random.Random(seed). A list of (shape, rotations).
+    '''
+    engine = Engine(level, clock = ManualClock(), rng = random.Random(seed))
+    return [engine.get_next_figure() for i in range(length)]
+
+
+class Solver(object):
+    def __init__(self, level, figures, seed = 0, think = 3, table_size = TABLE_SIZE, max_nodes = None):
+        '''
+        "figures" is the sequence of figures to deal, see figure_sequence().
+        The search gives up with SearchLimit after max_nodes positions.
+        '''
+        self.figures = figures
+        self.seed = seed
+        self.think = think
+        self.table_size = table_size
+        self.max_nodes = max_nodes
+        self.nodes = 0
+
+        self.keys = {}
+        self.key_rng = random.Random("zobrist %i" % seed)
+
+        engine = self.engine = Engine(level, clock = ManualClock(), rng = random.Random(seed))
+        engine.get_next_figure = self.deal
+        engine.start()
+        # Lines every figure can make at most: 2 per cell (a row and a column)
+        # of an element that isn't locked. lines[i][element] for the figures
+        # before the i-th one.
+        self.lines = [{}]
+        for shape, rotations in figures:
+            lines = dict(self.lines[-1])
+            for row in rotations[0]:
+                for cell in row:
+                    if cell and cell[-1] != LOCKED: lines[cell[0]] = lines.get(cell[0], 0) + 2
+            self.lines.append(lines)
+
+        # The hash of the start position, kept up to date from now on
+        self.hash = 0
+        for row, cells in enumerate(engine.grid):
+            for col, cell in enumerate(cells):
+                self.hash ^= self.key("cell", row, col, cell)
+                if engine.timer_grid[row][col]:
+                    self.hash ^= self.key("timer", row, col, engine.timer_grid[row][col])
+        for element, quantity in engine.goal.items():
+            self.hash ^= self.key("goal", element, quantity)
+        self.hash ^= self.key("dealt", engine.dealt)
+        self.hook(engine)
+        self.history = History(engine)
+
+        # Transposition tables: hash -> deepest search that found no win,
+        # (hash, depth) -> (best score gain, moves)
+        self.failed = collections.OrderedDict()
+        self.gains = collections.OrderedDict()
+
+    def key(self, *what):
+        '''The random key of a cell value, a timer deadline, a goal quantity or a number of figures dealt'''
+        if what not in self.keys:
+            self.keys[what] = self.key_rng.getrandbits(64)
+        return self.keys[what]
+
+    def hook(self, engine):
+        '''Update the hash on every change of a cell or a timer'''
+        board_set = engine.board.set
+        timers_set = engine.timers.set
+        grid = engine.grid
+        deadlines = engine.timer_grid
+
+        def set_cell(row, col, value):
+            old = grid[row][col]
+            if old != value:
+                self.hash ^= self.key("cell", row, col, old) ^ self.key("cell", row, col, value)
+            board_set(row, col, value)
+
+        def set_timer(row, col, deadline):
+            old = deadlines[row][col]
+            if old != deadline:
+                if old: self.hash ^= self.key("timer", row, col, old)
+                if deadline: self.hash ^= self.key("timer", row, col, deadline)
+            timers_set(row, col, deadline)
+
+        engine.board.set = set_cell
+        engine.timers.set = set_timer
+
+    def deal(self):
+        engine = self.engine
+        figure = self.figures[engine.dealt]
+        engine.dealt += 1
+        return figure
+
+    def moves(self, lines_only = False):
+        '''
+        Legal moves (rotation, row, col), the ones making the biggest lines
+        first. Moves making no line at all change neither the goal nor the
+        score, so they can be left out on the last move of a search.
+        '''
+        engine = self.engine
+        board = engine.board
+        scored = []
+        seen = []
+        for rotation, figure in enumerate(engine.figures):
+            # Symmetric figures look the same in some rotations
+            if figure in seen: continue
+            seen.append(figure)
+            for row, col in board.cells(board.placements(figure)):
+                value = match_value(engine, figure_cells(figure, row, col))
+                if value or not lines_only: scored.append((-value, rotation, row, col))
+        scored.sort()
+        return [(rotation, row, col) for value, rotation, row, col in scored]
+
+    def position(self):
+        '''What the solver needs, besides the engine's undo, to go back to this position'''
+        return self.hash, self.engine.clock.now
+
+    def play(self, move):
+        '''Make a move and let the game clock run for it'''
+        self.visit()
+        rotation, row, col = move
+        engine = self.engine
+        goal = dict(engine.goal)
+        dealt = engine.dealt
+        self.history.begin()
+        engine.rotation = rotation
+        engine.place(row, col)
+        for element, quantity in goal.items():
+            if engine.goal[element] != quantity:
+                self.hash ^= self.key("goal", element, quantity) ^ self.key("goal", element, engine.goal[element])
+        if engine.dealt != dealt:
+            self.hash ^= self.key("dealt", dealt) ^ self.key("dealt", engine.dealt)
+        engine.clock.advance(self.think)
+        engine.tick()
+        self.history.commit()
+
+    def undo(self, position):
+        '''Take back the last move, made from "position"'''
+        hash, now = position
+        # Back to the time of the move, so the timers are put back as they were
+        self.engine.clock.now = now
+        self.history.undo()
+        self.hash = hash
+
+    def can_reach(self, depth):
+        '''Whether the next "depth" figures can make enough lines for the goal at all'''
+        # The current figure is the one dealt before the last
+        first = self.engine.dealt - 2
+        last = min(first + depth, len(self.figures))
+        for element, quantity in self.engine.goal.items():
+            if quantity > self.lines[last].get(element, 0) - self.lines[first].get(element, 0):
+                return False
+        return True
+
+    def visit(self):
+        self.nodes += 1
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise SearchLimit()
+
+    @staticmethod
+    def lookup(table, key):
+        '''Get an entry of a transposition table, as the most recently used one'''
+        value = table.pop(key, None)
+        if value is not None: table[key] = value
+        return value
+
+    def store(self, table, key, value):
+        table.pop(key, None)
+        table[key] = value
+        if len(table) > self.table_size:
+            table.popitem(last = False)
+
+    def search(self, depth):
+        '''Moves winning the level within "depth" moves, or None'''
+        engine = self.engine
+        if engine.victory: return []
+        if depth == 0 or engine.defeat or engine.dealt >= len(self.figures): return None
+        if not self.can_reach(depth): return None
+        searched = self.lookup(self.failed, self.hash)
+        if searched is not None and searched >= depth: return None
+
+        position = self.position()
+        for move in self.moves(depth == 1):
+            self.play(move)
+            moves = self.search(depth - 1)
+            self.undo(position)
+            if moves is not None: return [move] + moves
+        self.store(self.failed, self.hash, depth)
+        return None
+
+    def solve(self, max_depth):
+        '''
+        The fewest moves (at most max_depth) winning the level, as a list
+        of (rotation, row, col), or None if there are none
+        '''
+        for depth in range(1, max_depth + 1):
+            moves = self.search(depth)
+            if moves is not None: return moves
+        return None
+
+    def best_gain(self, depth):
+        '''(best score gain, moves) within "depth" moves'''
+        engine = self.engine
+        if depth == 0 or engine.victory or engine.defeat or engine.dealt >= len(self.figures): return 0, []
+        best = self.lookup(self.gains, (self.hash, depth))
+        if best is not None: return best
+
+        best = (0, [])
+        score = engine.score
+        position = self.position()
+        for move in self.moves(depth == 1):
+            self.play(move)
+            gain = engine.score - score
+            later, moves = self.best_gain(depth - 1)
+            self.undo(position)
+            if gain + later > best[0]: best = (gain + later, [move] + moves)
+        self.store(self.gains, (self.hash, depth), best)
+        return best
+
+    def best_score(self, depth):
+        '''(best score reachable within "depth" moves, moves)'''
+        gain, moves = self.best_gain(depth)
+        return self.engine.score + gain, moves
+
+
+def main(args = None):
+    parser = optparse.OptionParser(usage = "%prog [options] LEVEL  (a number or a file in levels/)")
+    parser.add_option("-s", "--seed", type = "int", default = 0, help = "seed of the figure sequence [%default]")
+    parser.add_option("-d", "--depth", type = "int", default = 8, help = "most moves to look at [%default]")
+    parser.add_option("--nodes", type = "int", default = 200000, help = "give up after this many positions [%default]")
+    parser.add_option("--table", type = "int", default = TABLE_SIZE, help = "transposition table size [%default]")
+    parser.add_option("--think", type = "int", default = 3, help = "seconds every move takes [%default]")
+    parser.add_option("--score", action = "store_true", default = False,
+                      help = "find the best score within the depth instead of the fastest win")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("which level?")
+
+    level_id = args[0]
+    if level_id.isdigit(): level_id = "level_%s" % level_id
+    level = load_level(level_id)
+    # Two figures are dealt at the start, and one more with every move
+    figures = figure_sequence(level, options.seed, options.depth + 2)
+    solver = Solver(level, figures, options.seed, options.think, options.table, options.nodes)
+    start = time.time()
+    try:
+        if options.score:
+            score, moves = solver.best_score(options.depth)
+            print "Best score within %i moves: %i" % (options.depth, score)
+        else:
+            moves = solver.solve(options.depth)
+            if moves is None:
+                print "Not winnable within %i moves" % options.depth
+            else:
+                print "Winnable in %i moves" % len(moves)
+    except SearchLimit:
+        print "Gave up after %i positions" % solver.max_nodes
+        moves = None
+    for rotation, row, col in moves or []:
+        print "    rotation %i, row %i, col %i" % (rotation, row, col)
+    print "%i positions in %.1f s" % (solver.nodes, time.time() - start)
+
+if __name__ == '__main__':
+    main()
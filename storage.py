@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+#       Saving of "Alchemy: In search of the Philosopher's stone" files.
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+'''
+Settings and user progress files.
+
+Files are JSON documents with a "version" field, see SCHEMA_VERSION.
+They are written by a background thread, so the game never waits for the
+disk: several saves of the same file in a short time become one write,
+and every write goes to a temporary file that is synced to the disk and
+then renamed over the old one. A crash or a power loss leaves either the
+old file or the new one, never half of it.
+'''
+
+import json
+import os
+import threading
+import time
+
+# Version 0: files without a "version" field (written before it existed)
+# Version 1: the same fields plus "version"
+SCHEMA_VERSION = 1
+
+
+def upgrade_0(document):
+    document["version"] = 1
+
+# version -> function upgrading a document of that version to the next one
+UPGRADES = {
+    0: upgrade_0,
+    }
+
+
+def upgrade(document):
+    '''Bring a loaded document up to SCHEMA_VERSION'''
+    version = document.get("version", 0)
+    if version > SCHEMA_VERSION:
+        raise ValueError("Saved with a newer version of the game (%i)" % version)
+    while version < SCHEMA_VERSION:
+        UPGRADES[version](document)
+        version = document["version"]
+    return document
+
+
+def write_atomic(path, data):
+    '''Replace the file with "data" so that it's never seen half written'''
+    temp = path + ".tmp"
+    temp_file = open(temp, "wb")
+    try:
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    finally:
+        temp_file.close()
+    try:
+        os.rename(temp, path)
+    except OSError:
+        # Windows doesn't rename over an existing file
+        if not os.path.exists(path): raise
+        os.remove(path)
+        os.rename(temp, path)
+    # Make the rename itself survive a power loss
+    if hasattr(os, "O_DIRECTORY"):
+        directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+class SaveService(object):
+    '''
+    Loads documents and saves them on a background thread.
+    Call flush() to wait until everything is on the disk, close() when done.
+    '''
+    def __init__(self, delay = 0.5):
+        # Saves of the same file within "delay" seconds are written once
+        self.delay = delay
+        # path -> JSON waiting to be written (or being written)
+        self.pending = {}
+        # When the oldest pending save was made
+        self.since = None
+        self.flushing = 0
+        self.writing = False
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target = self.run, name = "saves")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def load(self, path):
+        '''A document as it was last saved, even if it isn't written yet'''
+        self.condition.acquire()
+        try:
+            data = self.pending.get(path)
+        finally:
+            self.condition.release()
+        if data is None:
+            document_file = open(path, "rb")
+            data = document_file.read()
+            document_file.close()
+        return upgrade(json.loads(data))
+
+    def save(self, path, document):
+        '''
+        Save a document. It's serialized right away, so it can be changed
+        after this call, and written a bit later.
+        '''
+        document["version"] = SCHEMA_VERSION
+        data = json.dumps(document)
+        self.condition.acquire()
+        try:
+            if not self.pending: self.since = time.time()
+            self.pending[path] = data
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    def flush(self):
+        '''Wait until all saves are written'''
+        self.condition.acquire()
+        try:
+            self.flushing += 1
+            self.condition.notify_all()
+            while (self.pending or self.writing) and self.thread.is_alive():
+                self.condition.wait(0.1)
+            self.flushing -= 1
+        finally:
+            self.condition.release()
+
+    def close(self):
+        '''Write everything that's pending and stop the thread'''
+        self.flush()
+        self.condition.acquire()
+        try:
+            self.closing = True
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        self.thread.join()
+
+    def run(self):
+        condition = self.condition
+        while True:
+            condition.acquire()
+            try:
+                while not self.pending and not self.closing:
+                    condition.wait()
+                if self.closing and not self.pending:
+                    return
+                # Give the game a moment to save the same files again
+                while not self.flushing and not self.closing and time.time() < self.since + self.delay:
+                    condition.wait(self.since + self.delay - time.time())
+                batch = dict(self.pending)
+                self.writing = True
+            finally:
+                condition.release()
+
+            for path, data in sorted(batch.items()):
+                try:
+                    write_atomic(path, data)
+                except (IOError, OSError), error:
+                    print "Could not save %s: %s" % (path, error)
+
+            condition.acquire()
+            try:
+                # Files saved again while we were writing are written next time
+                for path, data in batch.items():
+                    if self.pending.get(path) is data: del self.pending[path]
+                if self.pending: self.since = time.time()
+                self.writing = False
+                condition.notify_all()
+            finally:
+                condition.release()
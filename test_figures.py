@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+#       Tests of the figure table of "Alchemy: In search of the Philosopher's stone".
+#
+#       Copyright 2011 Valentina Mukhamedzhanova <umi@ubuntu.ru>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+
+import unittest
+
+from figures import table
+
+
+def rotate(figure):
+    '''The figure rotated clockwise, as the game has always rotated it'''
+    return [list(row) for row in zip(*figure[::-1])]
+
+
+class RotationTest(unittest.TestCase):
+    def test_rotations_keep_elements(self):
+        '''Every cell keeps its element when a figure of the table is rotated'''
+        for shape in table(5).shapes:
+            elements = [str(i) for i in range(shape.size)]
+            grids = [shape.grid(rotation, elements) for rotation in range(4)]
+            for rotation in range(4):
+                self.assertEqual(rotate(grids[rotation]), grids[(rotation + 1) % 4],
+                                 "shape %s, rotation %i" % (shape.canonical, rotation))
+
+    def test_domino(self):
+        shape = table(2).shapes[1]
+        self.assertEqual(shape.grid(0, ["1", "2"]), [["1", "2"]])
+        self.assertEqual(shape.grid(1, ["1", "2"]), [["1"], ["2"]])
+        self.assertEqual(shape.grid(2, ["1", "2"]), [["2", "1"]])
+
+
+if __name__ == '__main__':
+    unittest.main()